@@ -16,47 +16,320 @@
 Bibfetch frontent, calling all backends until one succeeds.
 """
 
+import collections
 import subprocess
 import os
 import re
 import logging
 import pprint
+import threading
+import time
+
+from bibman.util import ordered_map, gen_hash_md5, load_pickle, \
+        dump_pickle_atomic, CACHE_DIR
+
+FETCH_CACHE_PATH = os.path.join(CACHE_DIR, "bibfetch-cache")
+
+# Number of words of extracted text passed to backends as textsearch.
+TEXTSEARCH_WORDS = 20
+TEXTSEARCH_READ_SIZE = 4096
+
+NON_WORD_RE = re.compile(rb"\W")
+
+# Returned by Frontend.call_backend if the backend failed or timed out, as
+# opposed to returning no result.
+FAILED = object()
+
+class FetchCache:
+    """
+    Persistent LRU cache of extracted text and backend results, keyed on
+    (file digest, name); negative results (None) expire after negative_ttl
+    seconds.
+    """
+    def __init__(self, path=FETCH_CACHE_PATH, max_entries=10000,
+                 negative_ttl=7*24*3600):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        # Loaded on first use.
+        self.cache = None
+
+    def _load(self):
+        if self.cache is None:
+            self.cache = load_pickle(self.path)
+            if not isinstance(self.cache, collections.OrderedDict):
+                self.cache = collections.OrderedDict()
+
+    def get(self, digest, name):
+        """
+        @return (True, value) if cached, (False, None) otherwise.
+        """
+        key = (digest, name)
+
+        with self.lock:
+            self._load()
+            cached = self.cache.get(key)
+            if cached is None:
+                return False, None
+
+            timestamp, value = cached
+            if value is None and time.time() - timestamp > self.negative_ttl:
+                del self.cache[key]
+                self.dirty = True
+                return False, None
+
+            self.cache.move_to_end(key)
+            return True, value
+
+    def put(self, digest, name, value):
+        with self.lock:
+            self._load()
+            self.cache[(digest, name)] = (time.time(), value)
+            self.cache.move_to_end((digest, name))
+
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty: return
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        except OSError:
+            pass
+
+        with self.lock:
+            if dump_pickle_atomic(self.path, self.cache):
+                self.dirty = False
+            else:
+                logging.warning("Could not write fetch cache: {}".format(self.path))
+
+class RateLimiter:
+    """
+    Enforces a minimum interval between calls, across threads.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        if self.interval <= 0: return
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
 
 class Frontend:
     def __init__(self, args):
         self.backends = []
         for backend in args.fetch_prio_list:
-            self.backends.append(getattr(__import__("bibman.bibfetch.{}".format(backend),
-                    fromlist=["remote_fetch"]), "remote_fetch"))
+            # Backends outside of bibman.bibfetch can be given by full module
+            # name, e.g. for testing.
+            module = backend if "." in backend else "bibman.bibfetch.{}".format(backend)
+            self.backends.append((backend,
+                getattr(__import__(module, fromlist=["remote_fetch"]), "remote_fetch"),
+                RateLimiter(args.fetch_rate)))
+
+        self.jobs = args.fetch_jobs
+        self.timeout = args.fetch_timeout or None
+        self.pages = args.fetch_pages
+
+        if args.clear_fetch_cache:
+            logging.info("Clearing fetch cache: {}".format(FETCH_CACHE_PATH))
+            try:
+                os.unlink(os.path.expanduser(FETCH_CACHE_PATH))
+            except FileNotFoundError:
+                pass
+
+        self.cache = None
+        if args.fetch_cache:
+            self.cache = FetchCache(max_entries=args.fetch_cache_size,
+                                    negative_ttl=args.fetch_negative_ttl)
+
+    def extract_words(self, path):
+        """
+        Returns the first TEXTSEARCH_WORDS words of the text of the PDF at
+        path, or None on failure. The output of pdftotext is streamed, and
+        pdftotext is terminated as soon as enough words have been read.
+        """
+        cmd = ["pdftotext", "-q"]
+        if self.pages:
+            cmd += ["-l", str(self.pages)]
+        cmd += [os.path.expanduser(path), "-"]
+
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        except OSError as e:
+            logging.warning("Could not run pdftotext: {}".format(e))
+            return None
+
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            proc.kill()
+
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+
+        words = []
+        partial = b""
+
+        try:
+            while len(words) < TEXTSEARCH_WORDS:
+                chunk = proc.stdout.read1(TEXTSEARCH_READ_SIZE)
+                if not chunk:
+                    words.extend(partial.split())
+                    break
+
+                text = NON_WORD_RE.sub(b" ", partial + chunk)
+                tokens = text.split()
+
+                # The last word may continue in the next chunk.
+                partial = b""
+                if len(tokens) != 0 and not text.endswith(b" "):
+                    partial = tokens.pop()
+
+                words.extend(tokens)
+        finally:
+            if proc.poll() is None:
+                proc.terminate()
+            proc.stdout.close()
+            proc.wait()
+
+            if timer is not None:
+                timer.cancel()
+
+        if timed_out.is_set() and len(words) < TEXTSEARCH_WORDS:
+            logging.warning("pdftotext timed out: {}".format(path))
+            return None
+
+        return [word.decode() for word in words[:TEXTSEARCH_WORDS]]
 
     def extract_fileinfo(self, kwargs):
+        """
+        Adds textsearch to kwargs for PDF files.
+
+        @return (kwargs, complete), where complete is False if text extraction
+                failed or timed out.
+        """
         if "filename" in kwargs:
             if kwargs["filename"].split(".")[-1].lower() == "pdf":
-                pdftext = subprocess.Popen(["pdftotext", "-q",
-                    os.path.expanduser(kwargs["filename"]), "-"],
-                    stdout=subprocess.PIPE).communicate()[0]
-                pdftext = re.sub(b'\W', b' ', pdftext).decode()
-                words = pdftext.strip().split()[:20]
-
+                words = self.extract_words(kwargs["filename"])
+                if words is None:
+                    return kwargs, False
                 kwargs["textsearch"] = " ".join(words)
 
-        return kwargs
+        return kwargs, True
+
+    def call_backend(self, name, backend, rate_limiter, kwargs):
+        """
+        Calls backend in a separate thread, which is abandoned if it does not
+        return before the timeout.
+        """
+        rate_limiter.wait()
+        result = []
+
+        def run():
+            try:
+                result.append(backend(**kwargs))
+            except Exception as e:
+                logging.warning("Backend '{}' failed: {}".format(name, e))
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(self.timeout)
+
+        if thread.is_alive():
+            logging.warning("Backend '{}' timed out: {}".format(
+                name, kwargs.get("filename")))
+            return FAILED
+
+        return result[0] if len(result) != 0 else FAILED
 
     def __call__(self, **kwargs):
         """
+        @param md5 Optional MD5 hexdigest of the file, used as key for the
+                   cache; not passed on to backends.
         @return Dictionary with keys as in format modules (see format.bibtex
                 for an example). Missing entries will be added automatically.
         """
+        digest = kwargs.pop("md5", None)
+        if self.cache is not None and digest is None and "filename" in kwargs:
+            digest = gen_hash_md5(os.path.expanduser(kwargs["filename"])).hexdigest()
 
-        kwargs = self.extract_fileinfo(kwargs)
+        cache = self.cache if digest is not None else None
+        complete = True
+
+        if cache is not None:
+            cached, textsearch = cache.get(digest, "textsearch")
+            if cached:
+                if textsearch is not None:
+                    kwargs["textsearch"] = textsearch
+            else:
+                kwargs, complete = self.extract_fileinfo(kwargs)
+                # Failures (e.g. pdftotext missing or timed out) are retried
+                # on the next fetch.
+                if complete:
+                    cache.put(digest, "textsearch", kwargs.get("textsearch"))
+        else:
+            kwargs, complete = self.extract_fileinfo(kwargs)
 
         if logging.getLogger().isEnabledFor(logging.DEBUG):
             pp = pprint.PrettyPrinter(indent=4)
             logging.debug("(bibfetch/frontend:Frontend) __call__::kwargs =\n{}".format(
                 pp.pformat(kwargs)))
 
-        for backend in self.backends:
-            result = backend(**kwargs)
+        for name, backend, rate_limiter in self.backends:
+            if cache is not None:
+                cached, result = cache.get(digest, name)
+                if cached:
+                    logging.debug("Using cached result of '{}' for: {}".format(
+                        name, kwargs.get("filename")))
+                    if result is not None:
+                        return result
+                    continue
+
+            result = self.call_backend(name, backend, rate_limiter, kwargs)
+            if result is FAILED:
+                continue
+
+            # Without the extracted text, backends may find nothing that they
+            # would find with it; only cache their results if found.
+            if cache is not None and (complete or result is not None):
+                cache.put(digest, name, result)
+
             if result is not None:
                 return result
 
+    def flush(self):
+        """
+        Writes back the cache.
+        """
+        if self.cache is not None:
+            self.cache.save()
+
+    def fetch_many(self, items, get_kwargs):
+        """
+        Fetches for multiple items concurrently, with up to fetch_jobs
+        fetches in flight.
+
+        @param get_kwargs Function returning kwargs to call the frontend with
+                          for an item.
+        @return Generator of (item, result), in order of items.
+        """
+        def fetch(item):
+            return item, self(**get_kwargs(item))
+
+        return ordered_map(fetch, items, self.jobs)
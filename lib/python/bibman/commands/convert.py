@@ -0,0 +1,67 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Convert command: copies all entries of the bibliography file, except comments,
+to another file, e.g. to import a BibTeX file into a bibliography store, or to
+export one.
+"""
+
+import logging
+import os
+
+def main(conf):
+    try:
+        target_module = __import__("bibman.formats.{}".format(conf.args.to_format),
+                                   fromlist=["*"])
+    except ImportError as e:
+        logging.critical("{}".format(e))
+        return 1
+
+    if os.path.exists(conf.args.output) and not conf.args.append:
+        logging.critical("File exists (use --append to add to it): {}".format(
+            conf.args.output))
+        return 1
+
+    try:
+        bibfile = open(conf.args.bibfile, 'r')
+        outfile = open(conf.args.output, 'a+')
+    except Exception as e:
+        logging.critical("Could not open file: {}".format(e))
+        return 1
+
+    try:
+        source = conf.bibfmt_module.BibFmt(bibfile, **conf.bibfmt_args)
+        target = target_module.BibFmt(outfile, **conf.bibfmt_args)
+        count = target.append_entries(source.read_all_entries())
+        target.flush_index()
+
+        logging.info("Converted {} entries from '{}' ({}) to '{}' ({}).".format(
+            count, conf.args.bibfile, conf.args.format,
+            conf.args.output, conf.args.to_format))
+    finally:
+        bibfile.close()
+        outfile.close()
+
+def register_args(parser):
+    parser.add_argument("-o", "--output", metavar="FILE", type=str,
+            dest="output", required=True,
+            help="File to write the entries to.")
+    parser.add_argument("-t", "--to-format", metavar="FORMAT", type=str,
+            dest="to_format", default="bibstore",
+            help="Format of the output file, e.g. 'bibtex' or 'bibstore'. [Default:bibstore]")
+    parser.add_argument("--append", action="store_true",
+            dest="append", default=False,
+            help="Append to the output file, if it exists.")
+    parser.set_defaults(func=main)
@@ -18,35 +18,85 @@ Query command.
 
 import sys
 import os
+import json
 import logging
+import math
 import shutil
 
-from bibman.util import gen_filename_from_bib
+from bibman.util import gen_filename_from_bib, tokenize
+from bibman.querylang import compile_query, query_indices, union, QueryError
+
+# Pseudo-index to query all full-text indices, with matches weighted by field.
+TEXT_INDEX = "text"
+TEXT_WEIGHTS = {"title": 3.0, "author": 2.0, "journal": 1.0, "annotation": 1.0}
+
+def text_query(bibfmt, weights, query):
+    """
+    Queries full-text indices for entries matching all words in query; a word
+    ending in '*' matches all words with that prefix. Matches are scored by
+    the weight of the index and the rarity of the word.
+
+    @param weights Dict of index name to weight of matches in that index; the
+                   citekey index should also be built, to count entries.
+    @return List of (score, filepos), best match first.
+    """
+    num_entries = len(bibfmt.index.get("citekey") or ()) + 1
+    scores = None
+
+    for term in query.split():
+        words = tokenize(term)
+        for i, word in enumerate(words):
+            prefix = term.endswith("*") and i == len(words) - 1
+
+            word_scores = {}
+            for index, weight in weights.items():
+                if prefix:
+                    results = bibfmt.query_prefix(index, word)
+                else:
+                    results = [bibfmt.query(index, word) or []]
+
+                # Score an entry matching multiple words with the prefix by
+                # the rarest.
+                index_scores = {}
+                for filepos_list in results:
+                    idf = math.log(1 + num_entries / max(1, len(filepos_list)))
+                    for filepos in filepos_list:
+                        if index_scores.get(filepos, 0) < idf:
+                            index_scores[filepos] = idf
+
+                for filepos, idf in index_scores.items():
+                    word_scores[filepos] = word_scores.get(filepos, 0) + weight * idf
+
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {filepos: score + scores[filepos]
+                          for filepos, score in word_scores.items()
+                          if filepos in scores}
 
-def andor_query(bibfmt, index, values, andsep=','):
-    query_result = set()
+            if not scores:
+                return []
 
-    for value_or in values:
-        last_result = None
-        for value_and in value_or.split(andsep):
-            this_result = bibfmt.query(index, value_and) or []
-            if last_result is None:
-                last_result = set(this_result)
-            else:
-                last_result &= frozenset(this_result)
-        query_result |= last_result
+    if scores is None:
+        return []
 
-    return query_result
+    return sorted(((score, filepos) for filepos, score in scores.items()),
+                  reverse=True)
 
 def main(conf):
     bibfmt_module = conf.bibfmt_module
-    AVAIL_INDICES = [bibfmt_module.KEYWORDS, bibfmt_module.CITEKEY]
+    AVAIL_INDICES = [bibfmt_module.KEYWORDS, bibfmt_module.CITEKEY] + \
+            list(bibfmt_module.TEXT_FIELDS) + [TEXT_INDEX]
 
     if not conf.args.index in AVAIL_INDICES:
         logging.critical("Not a valid choice: {}. Available options are: {}".format(
                          conf.args.index, ",".join(AVAIL_INDICES)))
         return 1
 
+    if conf.args.batch and conf.args.index == TEXT_INDEX:
+        logging.critical("Not a valid choice with --batch: {}".format(TEXT_INDEX))
+        return 1
+
     try:
         bibfile = open(conf.args.bibfile, 'r')
     except Exception as e:
@@ -54,8 +104,7 @@ def main(conf):
         return 1
 
     try:
-        bibfmt = bibfmt_module.BibFmt(bibfile)
-        bibfmt.build_index(conf.args.index)
+        bibfmt = bibfmt_module.BibFmt(bibfile, **conf.bibfmt_args)
 
         if conf.args.value[0] != "-":
             values = (x for x in conf.args.value)
@@ -63,41 +112,110 @@ def main(conf):
             values = (x.strip() for x in sys.stdin)
 
         # Perform query
-        query_result = andor_query(bibfmt, conf.args.index, values)
+        if conf.args.index == TEXT_INDEX:
+            weights = TEXT_WEIGHTS
+        elif conf.args.index in bibfmt_module.TEXT_FIELDS:
+            weights = {conf.args.index: 1.0}
+        else:
+            weights = None
+
+        if conf.args.batch:
+            bibfmt.build_index(conf.args.index)
+
+            # Look up values as keys, without parsing them as queries.
+            results = []
+            for value in values:
+                if len(value) == 0: continue
+                filepos_list = bibfmt.query(conf.args.index, value)
+                if filepos_list is None:
+                    logging.warning("No matches: {}".format(value))
+                else:
+                    results.append(filepos_list)
+
+            query_result = union(results)
+        elif weights is not None:
+            bibfmt.build_index(bibfmt_module.CITEKEY, *weights)
+
+            # Best score of any of the queries.
+            scores = {}
+            for value in values:
+                for score, filepos in text_query(bibfmt, weights, value):
+                    scores[filepos] = max(score, scores.get(filepos, 0))
+
+            query_result = sorted(scores, key=lambda filepos: scores[filepos],
+                                  reverse=True)
+        else:
+            try:
+                plans = [compile_query(value, conf.args.index,
+                                       bibfmt_module.QUERY_FIELDS,
+                                       bibfmt_module.TEXT_FIELDS)
+                         for value in values]
+            except QueryError as e:
+                logging.critical("Invalid query: {}".format(e))
+                return 1
+
+            indices = set()
+            for plan in plans:
+                indices |= query_indices(plan)
+            bibfmt.build_index(*indices)
+
+            query_result = union([plan.evaluate(bibfmt) for plan in plans])
 
         # Show results
         if len(query_result) == 0:
             logging.info("No matches.")
         else:
-            for filepos in sorted(query_result):
+            # Read all entries in one pass over the file, in file order.
+            entries = bibfmt.read_entries(query_result)
+            if weights is not None and not conf.args.batch:
+                # Ranked results
+                read = {entry.filepos: entry for entry in entries}
+                entries = (read[filepos] for filepos in query_result)
+
+            for entry in entries:
                 if conf.args.copy is not None:
                     if not os.path.isdir(conf.args.copy):
                         logging.critical("Not a valid path: {}".format(conf.args.copy))
                         return 1
 
-                    querydict = bibfmt.read_entry_dict(filepos)
-                    filepath = querydict["file"]
+                    filepath = entry["file"]
 
                     if conf.args.rename:
                         destpath = os.path.join(conf.args.copy,
-                                gen_filename_from_bib(querydict))
+                                gen_filename_from_bib(entry))
                     else:
                         destpath = conf.args.copy
 
                     logging.info("Copying: '{}' to '{}'".format(filepath, destpath))
                     shutil.copy(os.path.expanduser(filepath), destpath)
+                elif conf.args.output == "json":
+                    print(json.dumps(dict(entry)))
                 else:
-                    print(bibfmt.read_entry_raw(filepos))
+                    print(entry.text())
     finally:
         bibfile.close()
 
 def register_args(parser):
     parser.add_argument("-i", "--index", type=str,
             dest="index", default="citekey",
-            help="Index to query. [Default:citekey]")
+            help="Index to query: citekey, keywords, a full-text index "
+                 "(author, title, journal, annotation), or 'text' for all "
+                 "full-text indices. [Default:citekey]")
     parser.add_argument(type=str,
             dest="value", nargs="+",
-            help="Query value; 'or' semantics for multiple arguments, 'and' semantics with ',' within one argument.")
+            help="Query; 'or' semantics for multiple arguments. For citekey and keywords, "
+                 "a boolean expression of values of the index, or of other fields as field:value "
+                 "(see bibman.querylang), e.g. 'machine learning, (cache OR year:2000..2005) NOT author:smith'; "
+                 "adjacent words form one value, so separate terms with ',' or AND. "
+                 "For full-text indices, 'and' semantics for words within one argument, "
+                 "with words ending in '*' matching by prefix; results are ranked.")
+    parser.add_argument("--batch", action="store_true",
+            dest="batch", default=False,
+            help="Look up each value (e.g. one per line with '-') as a key of the index, "
+                 "without query syntax; reports values without match.")
+    parser.add_argument("-o", "--output", type=str, choices=["raw", "json"],
+            dest="output", default="raw",
+            help="Output format: raw entries, or JSON lines of their fields. [Default:raw]")
     parser.add_argument("-c", "--copy", metavar="PATH", type=str,
             dest="copy", default=None,
             help="Copy associated files to PATH.")
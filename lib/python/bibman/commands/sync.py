@@ -22,12 +22,17 @@ import datetime
 import shutil
 import string
 
-from bibman.util import gen_hash_md5, gen_filename_from_bib
+from bibman.util import gen_hash_md5, gen_filename_from_bib, ordered_map, \
+        HashCache, FileWalker
 
 class SyncCommand:
     def __init__(self, conf, bibfile, excludefiles):
         self.conf = conf
-        self.bibfmt_main = bibfmt_module.BibFmt(bibfile)
+        self.hash_cache = HashCache() if self.conf.args.hash_cache else None
+        # BibFmt -> edits of entries which could not be updated in place (see
+        # BibFmt.rewrite).
+        self.pending_edits = {}
+        self.bibfmt_main = bibfmt_module.BibFmt(bibfile, **conf.bibfmt_args)
 
         indices = [bibfmt_module.FILE, bibfmt_module.CITEKEY]
         if self.conf.args.hash:
@@ -37,35 +42,32 @@ class SyncCommand:
 
         self.bibfmt_efs = []
         for fh in excludefiles:
-            bi = bibfmt_module.BibFmt(fh)
+            bi = bibfmt_module.BibFmt(fh, **conf.bibfmt_args)
             bi.build_index(*indices)
             self.bibfmt_efs.append(bi)
 
         # Sanity check data and warn
         for idx in indices:
-            main_set = frozenset(self.bibfmt_main.index[idx])
+            main_index = self.bibfmt_main.index[idx]
             for bi in self.bibfmt_efs:
-                duplicate_set = set(bi.index[idx])
-                duplicate_set &= main_set
+                duplicate_set = {key for key in bi.index[idx] if key in main_index}
 
                 if len(duplicate_set) != 0:
                     logging.warning("Duplicates found in '{}': {} = {}".format(
                         bi.bibfile.name, idx, duplicate_set))
 
     def walk_path(self):
+        roots = []
         for path in self.conf.args.paths:
             if not os.path.isdir(path):
                 logging.error("Could not find directory: {}".format(path))
                 continue
+            roots.append(path)
 
-            for root, dirs, files in os.walk(path):
-                for f in files:
-                    fullpath = os.path.abspath(os.path.join(root, f))
-                    if fullpath.startswith(os.environ['HOME']):
-                        fullpath = fullpath.replace(os.environ['HOME'], "~", 1)
-
-                    if fullpath.split(".")[-1] in self.conf.args.extlist:
-                        yield fullpath
+        walker = FileWalker(self.conf.args.extlist,
+                            include=self.conf.args.include,
+                            exclude=self.conf.args.ignore)
+        return walker.walk_all(roots, self.conf.args.walk_jobs)
 
     def query_exists_in(self, index, value):
         """
@@ -90,31 +92,61 @@ class SyncCommand:
             found = True
 
             query_filepos = bi.query(bibfmt_module.HASH, digest)
-            query_result = bi.read_entry_dict(query_filepos)
+            query_result = bi.read_entry(query_filepos)
             duplicate = query_result["file"]
             citekey = query_result["citekey"]
 
             if not os.path.exists(duplicate) and bi.bibfile.writable():
-                if not self.conf.args.append or not bi.update_in_place(query_filepos,
-                        bibfmt_module.FILE, duplicate, path):
+                if not self.conf.args.append:
                     logging.warning("File '{}' missing; suggested fix: update '{}' in '{}' with '{}'".format(
                         duplicate, citekey, bi.bibfile.name, path))
-                else:
+                elif bi.update_in_place(query_filepos, bibfmt_module.FILE, duplicate, path):
                     # Could update in-place
                     logging.info("Updated entry for '{}' with '{}'".format(
                         citekey, path))
+                else:
+                    # Rewrite the file once for all such updates, at the end.
+                    self.pending_edits.setdefault(bi, {})[query_filepos] = \
+                            {bibfmt_module.FILE: path}
+                    logging.info("Will update entry for '{}' with '{}'".format(
+                        citekey, path))
             else:
                 logging.warning("Duplicate for '{}' found in '{}': citekey = '{}'".format(
                     path, bi.bibfile.name, citekey))
 
         return found
 
-    def verify_hash(self, path):
+    def gen_digest(self, path, force=False):
+        if self.hash_cache is not None:
+            return self.hash_cache.hexdigest(path, force)
+        return gen_hash_md5(os.path.expanduser(path)).hexdigest()
+
+    def walk_path_digests(self):
+        """
+        Generates (path, digest) for all paths, where digest is the MD5
+        hexdigest if it will be needed, otherwise None. Digests are computed
+        by a pool of threads ahead of the paths being processed.
+        """
+        def with_digest(path):
+            if self.query_exists(bibfmt_module.FILE, path) is not None:
+                if self.conf.args.verify and \
+                        self.bibfmt_main.query(bibfmt_module.FILE, path) is not None:
+                    return path, self.gen_digest(path, force=self.conf.args.full)
+            elif self.conf.args.hash:
+                return path, self.gen_digest(path)
+
+            return path, None
+
+        return ordered_map(with_digest, self.walk_path(), self.conf.args.hash_jobs)
+
+    def verify_hash(self, path, digest):
         # Only verify entries in main.
         query_filepos = self.bibfmt_main.query(bibfmt_module.FILE, path)
         if query_filepos is None: return  # not in main
-        query_result = self.bibfmt_main.read_entry_dict(query_filepos)
-        digest = gen_hash_md5(os.path.expanduser(path)).hexdigest()
+        # Not hashed ahead if it was not yet in main (see walk_path_digests).
+        if digest is None:
+            digest = self.gen_digest(path, force=self.conf.args.full)
+        query_result = self.bibfmt_main.read_entry(query_filepos)
         if digest != query_result["md5"]:
             logging.warn("MD5 checksum mismatch: {} ({} != {})".format(
                 path, digest, query_result["md5"]))
@@ -135,11 +167,18 @@ class SyncCommand:
 
         return new_entry_args
 
-    def __call__(self):
-        for path in self.walk_path():
+    def new_entries(self):
+        """
+        Generates arguments for new entries for all paths not yet in any of
+        the bibliography files, checking existing entries along the way.
+        """
+        # Digests of new entries generated, but possibly not yet added.
+        new_digests = set()
+
+        for path, digest in self.walk_path_digests():
             # Check existing entries
             if self.query_exists(bibfmt_module.FILE, path) is not None:
-                if self.conf.args.verify: self.verify_hash(path)
+                if self.conf.args.verify: self.verify_hash(path, digest)
                 continue
 
             # Generate new entry
@@ -155,8 +194,11 @@ class SyncCommand:
                     date_added=datetime.date.today().strftime("%Y-%m-%d"))
 
             if self.conf.args.hash:
-                new_entry_args["md5"] = gen_hash_md5(
-                        os.path.expanduser(path)).hexdigest()
+                # Not hashed ahead if the path was in an index then, but its
+                # entry was since updated to another path (see check_hash).
+                if digest is None:
+                    digest = self.gen_digest(path)
+                new_entry_args["md5"] = digest
 
                 # Before we proceed, check if this file is a duplicate of an
                 # already existing file, and if so, check existing entry is
@@ -164,10 +206,37 @@ class SyncCommand:
                 if self.check_hash(new_entry_args["md5"], path):
                     continue
 
-            if self.conf.args.remote:
-                logging.info("Attempting to fetch bibliography information remotely: {}".format(
-                    path))
-                new_entry_args.update(self.conf.bibfetch(filename=path))
+                if digest in new_digests:
+                    logging.warning("Duplicate for '{}' found in new entries: md5 = '{}'".format(
+                        path, digest))
+                    continue
+                new_digests.add(digest)
+
+            yield new_entry_args
+
+    def fetch_remote(self, new_entries):
+        """
+        Updates new entries with remotely fetched information; fetches run
+        concurrently, ahead of the entries being generated.
+        """
+        def get_kwargs(new_entry_args):
+            logging.info("Attempting to fetch bibliography information remotely: {}".format(
+                new_entry_args["file"]))
+            return dict(filename=new_entry_args["file"],
+                        md5=new_entry_args.get("md5"))
+
+        for new_entry_args, result in self.conf.bibfetch.fetch_many(new_entries, get_kwargs):
+            if result is not None:
+                new_entry_args.update(result)
+            yield new_entry_args
+
+    def __call__(self):
+        new_entries = self.new_entries()
+        if self.conf.args.remote:
+            new_entries = self.fetch_remote(new_entries)
+
+        for new_entry_args in new_entries:
+            path = new_entry_args["file"]
 
             if self.conf.args.interactive:
                 new_entry_args = self.interactive_corrections(new_entry_args)
@@ -200,6 +269,20 @@ class SyncCommand:
             else:
                 self.bibfmt_main.print_new_entry(**new_entry_args)
 
+        for bi, edits in self.pending_edits.items():
+            if bi.rewrite(edits):
+                logging.info("Updated {} entries in '{}'.".format(len(edits), bi.bibfile.name))
+            else:
+                logging.warning("Could not update entries in '{}'.".format(bi.bibfile.name))
+
+        self.bibfmt_main.flush_index()
+        if self.conf.args.remote:
+            self.conf.bibfetch.flush()
+        if self.hash_cache is not None:
+            self.hash_cache.save()
+            logging.info("MD5 sums: {} files unchanged (skipped), {} files hashed.".format(
+                self.hash_cache.skipped, self.hash_cache.hashed))
+
 def main(conf):
     global bibfmt_module
     bibfmt_module = conf.bibfmt_module
@@ -217,7 +300,12 @@ def main(conf):
 
     try:
         sync_cmd = SyncCommand(conf, bibfile, excludefiles)
-        sync_cmd()
+        try:
+            sync_cmd()
+        finally:
+            # Files rewritten by BibFmt.rewrite are reopened.
+            for bi in [sync_cmd.bibfmt_main] + sync_cmd.bibfmt_efs:
+                bi.bibfile.close()
     finally:
         bibfile.close()
         for fh in excludefiles:
@@ -228,8 +316,18 @@ def register_args(parser):
             dest="paths", nargs="+", required=True,
             help="Paths to scan and synchronise BIBFILE with.")
     parser.add_argument("--extlist", type=str,
-            dest="extlist", default="pdf", nargs="+",
+            dest="extlist", default=["pdf"], nargs="+",
             help="File-extensions to consider for sync. [Default:pdf]")
+    parser.add_argument("--include", metavar="GLOB", type=str,
+            dest="include", default=None, nargs="+",
+            help="Only consider files matching one of the patterns.")
+    parser.add_argument("--ignore", metavar="GLOB", type=str,
+            dest="ignore", default=None, nargs="+",
+            help="Skip files and directories matching one of the patterns; "
+                 "patterns are also read from .bibmanignore files.")
+    parser.add_argument("--walk-jobs", metavar="N", type=int,
+            dest="walk_jobs", default=4,
+            help="Number of threads to walk multiple paths with. [Default:4]")
     parser.add_argument("-a", "--append", action='store_true',
             dest="append", default=False,
             help="Append to BIBFILE instead of printing to stdout.")
@@ -239,6 +337,12 @@ def register_args(parser):
     parser.add_argument("--nohash", action="store_false",
             dest="hash", default=True,
             help="Do not generate MD5 sums and check duplicates.")
+    parser.add_argument("--hash-jobs", metavar="N", type=int,
+            dest="hash_jobs", default=4,
+            help="Number of threads to generate MD5 sums with. [Default:4]")
+    parser.add_argument("--no-hash-cache", action="store_false",
+            dest="hash_cache", default=True,
+            help="Do not use or update the cache of MD5 sums of unchanged files.")
     parser.add_argument("-i", "--interactive", action="store_true",
             dest="interactive", default=False,
             help="Interactive synchronisation, prompting the user for entry corrections.")
@@ -250,6 +354,9 @@ def register_args(parser):
             help="Rename file to be more descriptive; only valid with --interactive.")
     parser.add_argument("--verify", action="store_true",
             dest="verify", default=False,
-            help="Verify checksum of all existing entries.")
+            help="Verify checksum of all existing entries; only files changed since they were last hashed are re-hashed.")
+    parser.add_argument("--full", action="store_true",
+            dest="full", default=False,
+            help="Only valid with --verify: re-hash all files, even if unchanged.")
     parser.set_defaults(func=main)
 
@@ -16,15 +16,26 @@
 Webserve command.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import copy
+import json
 import os
+import socket
 import logging
+import mimetypes
 import bottle
 import re
+import threading
+import time
+import urllib.parse
 
 from bibman.util import gen_filename_from_bib
-from bibman.commands.query import andor_query
+from bibman.commands.query import text_query, TEXT_WEIGHTS
+from bibman.querylang import compile_query, QueryError
 
-DEFAULT_REPONSE_HTML = """<html>
+# Header and footer are also used separately for streamed responses.
+RESPONSE_HTML_HEADER = """<html>
 <head>
 <title>{{title}}</title>
 <style>
@@ -33,36 +44,290 @@ body {
 }
 </style>
 </head>
-% for line in lines:
+"""
+
+RESPONSE_HTML_FOOTER = "</html>"
+
+DEFAULT_REPONSE_HTML = RESPONSE_HTML_HEADER + """% for line in lines:
     {{!line}}<br>
 % end
-</html>"""
+""" + RESPONSE_HTML_FOOTER
 
 @bottle.route("/file/<citekey>/<dlname>")
 def index(citekey, dlname):
-    query_result = bibfmt.query('citekey', citekey)
-    if not query_result:
-        return bottle.abort(404, "No such citekey: {}".format(citekey))
+    lib = get_library()
 
-    if len(query_result) != 1:
-        return bottle.abort(404, "Citekey not unique: {}".format(citekey))
-
-    filepos = query_result[0]
-
-    querydict = bibfmt.read_entry_dict(filepos)
-    path = os.path.expanduser(querydict['file'])
+    path = lib.file_path(citekey)
+    if path is None:
+        return bottle.abort(404, "No unique entry with file for citekey: {}".format(citekey))
 
-    if not os.path.exists(path):
+    try:
+        f = open(path, 'rb')
+    except OSError:
         return bottle.abort(404, "No file found: {}".format(path))
 
-    root = os.path.dirname(path)
-    filename = os.path.basename(path)
-
-    return bottle.static_file(filename, root=root)
-
-def process_filepos(filepos):
-    querydict = bibfmt.read_entry_dict(filepos)
-    raw = bibfmt.read_entry_raw(filepos)
+    try:
+        st = os.fstat(f.fileno())
+        headers = check_modified(make_etag(st.st_size, st.st_mtime_ns, st.st_ino),
+                                 st.st_mtime_ns)
+
+        mimetype, encoding = mimetypes.guess_type(path)
+        headers["Content-Type"] = mimetype or "application/octet-stream"
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        headers["Accept-Ranges"] = "bytes"
+
+        offset, length = 0, st.st_size
+        status = 200
+
+        range_header = bottle.request.get_header("Range")
+        if range_header is not None and if_range_matches(headers):
+            ranges = list(bottle.parse_range_header(range_header, st.st_size))
+            if not ranges:
+                f.close()
+                return bottle.HTTPResponse(status=416, headers={
+                    "Content-Range": "bytes */{}".format(st.st_size)})
+
+            # Only a single range is supported, as by bottle.static_file.
+            offset, end = ranges[0]
+            length = end - offset
+            headers["Content-Range"] = "bytes {}-{}/{}".format(offset, end - 1, st.st_size)
+            status = 206
+
+        headers["Content-Length"] = str(length)
+    except:
+        f.close()
+        raise
+
+    # The server sends the body via wsgi.file_wrapper, which may use
+    # sendfile.
+    return bottle.HTTPResponse(FileRange(f, offset, length), status=status,
+                               headers=headers)
+
+class FileRange:
+    """
+    File-like object to read length bytes of file f from offset. Provides
+    fileno, so that servers supporting it can send the range with sendfile
+    (starting at the current position of the file).
+    """
+    def __init__(self, f, offset, length):
+        f.seek(offset)
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+def make_etag(*state):
+    return '"{}"'.format("-".join("{:x}".format(x) for x in state))
+
+def check_modified(etag, mtime_ns):
+    """
+    Sets ETag and Last-Modified of the response; raises a 304 response if
+    the client already has the current version.
+
+    @return The headers set.
+    """
+    mtime = mtime_ns // 1000000000
+
+    headers = {"ETag": etag, "Last-Modified": bottle.http_date(mtime)}
+    for name, value in headers.items():
+        bottle.response.set_header(name, value)
+
+    if_none_match = bottle.request.get_header("If-None-Match")
+    if if_none_match is not None:
+        not_modified = etag in (tag.strip() for tag in if_none_match.split(",")) \
+                or if_none_match.strip() == "*"
+    else:
+        since = bottle.parse_date(
+                bottle.request.get_header("If-Modified-Since", "").split(";")[0].strip())
+        not_modified = since is not None and since >= mtime
+
+    if not_modified:
+        raise bottle.HTTPResponse(status=304, headers=headers)
+
+    return headers
+
+def if_range_matches(headers):
+    """
+    @return False if the request has an If-Range header not matching the
+            current version (see check_modified), and the full content must
+            be sent instead of the requested range.
+    """
+    if_range = bottle.request.get_header("If-Range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == headers["ETag"]
+    return if_range == headers["Last-Modified"]
+
+def check_library_modified(lib):
+    """
+    check_modified for responses depending on the state of the bibfile the
+    library was loaded from.
+    """
+    return check_modified(make_etag(*lib.signature), lib.signature[1])
+
+def file_signature(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+class Library:
+    """
+    The served bibliography: index, and optionally preloaded entries and
+    cached HTML of rendered entries. Never modified once in use; replaced as a
+    whole when the bibfile changes.
+    """
+    def __init__(self, conf, bibfile, preload=False):
+        self.signature = file_signature(bibfile.name)
+        self.bibfmt = bibfmt_module.BibFmt(bibfile, **conf.bibfmt_args)
+        self.bibfmt.build_index(*bibfmt_module.QUERY_FIELDS)
+
+        self.entries = None
+        self.html = None
+        # citekey -> path of file, or None; filled on first request.
+        self.paths = {}
+
+        if preload:
+            self.entries = {}
+            self.html = {}
+            self._preload(0)
+            logging.info("Preloaded {} entries.".format(len(self.entries)))
+
+    def _preload(self, start_pos):
+        # Read entries in file order.
+        entry_offsets = self.bibfmt.entry_offsets()
+        for entry in self.bibfmt.read_entries(
+                entry_offsets[bisect.bisect_left(entry_offsets, start_pos):]):
+            self.entries[entry.filepos] = entry
+
+    def updated(self):
+        """
+        Returns new library, with entries appended to the bibfile since this
+        library was loaded; returns None if the bibfile was changed otherwise.
+        """
+        signature = file_signature(self.bibfmt.bibfile.name)
+
+        bibfmt = self.bibfmt.updated()
+        if bibfmt is None:
+            return None
+
+        result = copy.copy(self)
+        result.signature = signature
+        result.bibfmt = bibfmt
+        # Appended entries may make citekeys ambiguous.
+        result.paths = {}
+
+        if self.entries is not None:
+            # Cached entries and HTML of the unchanged part remain valid.
+            result.entries = dict(self.entries)
+            result.html = dict(self.html)
+            result._preload(self.bibfmt.scan_state[0])
+
+        return result
+
+    def read_entry(self, filepos):
+        """
+        @return Entry at filepos.
+        """
+        if self.entries is not None:
+            return self.entries[filepos]
+        return self.bibfmt.read_entry(filepos)
+
+    def file_path(self, citekey):
+        """
+        @return Path of the file of the entry with citekey, or None if there
+                is no unique such entry with a file.
+        """
+        try:
+            return self.paths[citekey]
+        except KeyError:
+            pass
+
+        path = None
+        query_result = self.bibfmt.query('citekey', citekey)
+        if query_result and len(query_result) == 1:
+            entry = self.read_entry(query_result[0])
+            if 'file' in entry:
+                path = os.path.abspath(os.path.expanduser(entry['file']))
+
+        self.paths[citekey] = path
+        return path
+
+    def render(self, filepos):
+        """
+        @return List of HTML lines of entry at filepos.
+        """
+        if self.html is None:
+            return process_filepos(self.read_entry(filepos))
+
+        lines = self.html.get(filepos)
+        if lines is None:
+            lines = self.html[filepos] = process_filepos(self.read_entry(filepos))
+        return lines
+
+def watch_library(interval):
+    """
+    Polls the bibfile for changes, and replaces the library: if entries were
+    only appended, these are indexed incrementally, otherwise the library is
+    reloaded. Requests continue to use the previous library until the new one
+    is ready.
+    """
+    global library
+
+    while True:
+        time.sleep(interval)
+
+        lib = library
+        try:
+            if file_signature(bibfile.name) == lib.signature:
+                continue
+
+            new_lib = lib.updated()
+            if new_lib is not None:
+                logging.info("Indexed entries appended to: {}".format(bibfile.name))
+            else:
+                logging.info("Reloading changed bibliography file: {}".format(bibfile.name))
+                # Reopen, in case the file was replaced rather than modified;
+                # the previous file is closed once no longer in use.
+                new_lib = Library(webserve_conf, open(bibfile.name, 'r'),
+                                  lib.entries is not None)
+
+            library = new_lib
+        except Exception as e:
+            logging.error("Could not reload bibliography file: {}".format(e))
+
+watcher_lock = threading.Lock()
+watcher_pid = None
+
+def get_library():
+    """
+    Returns current library, and starts the watcher thread in this process,
+    if not yet running (threads do not survive forking of worker processes).
+    """
+    global watcher_pid
+
+    if webserve_conf.args.reload_interval > 0 and watcher_pid != os.getpid():
+        with watcher_lock:
+            if watcher_pid != os.getpid():
+                threading.Thread(target=watch_library,
+                                 args=(webserve_conf.args.reload_interval,),
+                                 daemon=True).start()
+                watcher_pid = os.getpid()
+
+    return library
+
+def process_filepos(entry):
     lines = []
 
     def re_cite_replace(m):
@@ -74,7 +339,7 @@ def process_filepos(filepos):
 
     # FIXME: Modifying URLs into links only works with BibTeX bibliographies
     # right now.
-    for line in raw.split("\n"):
+    for line in entry.text().split("\n"):
         # Get indenting spaces
         html_whitespace = []
         for i in range(len(line)):
@@ -85,10 +350,10 @@ def process_filepos(filepos):
         line = line.strip()
 
         if line.startswith("@"):
-            if 'file' in querydict:
+            if 'file' in entry:
                 html = bottle.template("<a href=\"/file/{{citekey}}/{{dlname}}\">{{line}}</a>",
-                        citekey=querydict['citekey'],
-                        dlname=gen_filename_from_bib(querydict), line=line)
+                        citekey=entry['citekey'],
+                        dlname=gen_filename_from_bib(entry), line=line)
             else:
                 html = bottle.template("{{line}}", line=line)
         elif line.startswith("file "):
@@ -110,7 +375,8 @@ def process_filepos(filepos):
 
 @bottle.route("/citekey/<citekey>")
 def index(citekey):
-    query_result = bibfmt.query("citekey", citekey)
+    lib = get_library()
+    query_result = lib.bibfmt.query("citekey", citekey)
 
     if not query_result:
         return bottle.abort(404, "No such citekey: {}".format(citekey))
@@ -118,26 +384,254 @@ def index(citekey):
     if len(query_result) != 1:
         return bottle.abort(404, "Citekey not unique: {}".format(citekey))
 
-    lines = process_filepos(query_result[0])
+    lines = lib.render(query_result[0])
 
     return bottle.template(DEFAULT_REPONSE_HTML,
                            title="{} @ {}".format(bibfile.name, citekey),
                            lines=lines)
 
+def page_links(offset, limit, total):
+    """
+    @return HTML links to the previous and next page of results of the
+            current request.
+    """
+    def link(offset, text):
+        query = dict(bottle.request.query.items())
+        query.update(offset=offset, limit=limit)
+        return bottle.template("<a href=\"{{url}}\">{{!text}}</a>", text=text,
+                url="{}?{}".format(urllib.parse.quote(bottle.request.path),
+                                   urllib.parse.urlencode(query)))
+
+    links = []
+    if offset > 0:
+        links.append(link(max(0, offset - limit), "&lt; prev"))
+    if offset + limit < total:
+        links.append(link(offset + limit, "next &gt;"))
+    return " ".join(links)
+
+def paginated_response(lib, name, query_result):
+    """
+    Returns page of rendered entries selected by offset and limit query
+    parameters, streamed as they are rendered.
+
+    @param query_result List of filepos in lib, in order.
+    """
+    if len(query_result) == 0:
+        return bottle.abort(404, "No matching results: {}".format(name))
+
+    try:
+        offset = max(0, int(bottle.request.query.get("offset", 0)))
+        limit = int(bottle.request.query.get("limit", webserve_conf.args.page_size))
+    except ValueError:
+        return bottle.abort(400, "Invalid offset or limit.")
+
+    if limit <= 0:
+        limit = len(query_result)
+
+    if offset >= len(query_result):
+        return bottle.abort(404, "No results at offset: {}".format(offset))
+
+    page = query_result[offset:offset + limit]
+    nav = page_links(offset, limit, len(query_result))
+    title = "{} @ {} [{}-{} of {}]".format(bibfile.name, name, offset + 1,
+                                          offset + len(page), len(query_result))
+
+    # Stream entries as they are rendered, rather than rendering the whole
+    # page first.
+    def generate():
+        yield bottle.template(RESPONSE_HTML_HEADER, title=title)
+        yield nav + "<br>\n"
+        for filepos in page:
+            yield "".join(line + "<br>\n" for line in lib.render(filepos))
+        yield nav + "\n"
+        yield RESPONSE_HTML_FOOTER
+
+    return generate()
+
 @bottle.route("/keywords/<keywords>")
 def index(keywords):
-    query_result = andor_query(bibfmt, "keywords", keywords.split("~"))
+    lib = get_library()
+    try:
+        query_result = keywords_query(lib, keywords)
+    except QueryError as e:
+        return bottle.abort(400, "Invalid query: {}".format(e))
+    return paginated_response(lib, keywords, query_result)
+
+def keywords_query(lib, keywords):
+    """
+    Evaluates query (see querylang) with keywords as default index.
+
+    @return List of filepos, newest first.
+    """
+    plan = compile_query(keywords, bibfmt_module.KEYWORDS,
+                         bibfmt_module.QUERY_FIELDS, bibfmt_module.TEXT_FIELDS)
+    return plan.evaluate(lib.bibfmt)[::-1]
+
+@bottle.route("/search")
+def index():
+    """
+    Full-text search; query parameter q is the query (see text_query), and
+    the optional fields a comma separated list of fields to search.
+    """
+    lib = get_library()
+    query = bottle.request.query.get("q", "")
+
+    weights = search_weights()
+    if weights is None:
+        return bottle.abort(400, "Invalid fields: {}".format(bottle.request.query.fields))
+
+    query_result = [filepos for _, filepos in text_query(lib.bibfmt, weights, query)]
+    return paginated_response(lib, query, query_result)
+
+def search_weights():
+    """
+    @return Weights of the fields to search (see text_query), as given by the
+            fields query parameter, or None if invalid.
+    """
+    if "fields" not in bottle.request.query:
+        return TEXT_WEIGHTS
+
+    fields = bottle.request.query.get("fields").split(",")
+    if not all(field in TEXT_WEIGHTS for field in fields):
+        return None
+    return {field: TEXT_WEIGHTS[field] for field in fields}
+
+def api_error(status, message):
+    return bottle.HTTPResponse(json.dumps({"error": message}), status=status,
+                               content_type="application/json")
+
+@bottle.route("/api/citekey/<citekey>")
+def index(citekey):
+    lib = get_library()
+    check_library_modified(lib)
 
-    if len(query_result) == 0:
-        return bottle.abort(404, "No matching results: {}".format(keywords))
+    query_result = lib.bibfmt.query("citekey", citekey)
+    if not query_result:
+        return api_error(404, "No such citekey: {}".format(citekey))
 
-    lines = []
-    for filepos in sorted(query_result, reverse=True):
-        lines += process_filepos(filepos)
+    if len(query_result) != 1:
+        return api_error(404, "Citekey not unique: {}".format(citekey))
+
+    return dict(lib.read_entry(query_result[0]))
+
+@bottle.route("/api/citekeys", method=["GET", "POST"])
+def index():
+    """
+    Batch lookup of the citekeys given as comma separated 'citekeys' query
+    parameter, or as JSON list in the request body.
+    """
+    lib = get_library()
+
+    if bottle.request.method == "POST":
+        citekeys = bottle.request.json
+        if not isinstance(citekeys, list):
+            return api_error(400, "Expected JSON list of citekeys.")
+    else:
+        check_library_modified(lib)
+        citekeys = [ck for ck in bottle.request.query.get("citekeys", "").split(",") if ck]
+
+    result = {}
+    for citekey in citekeys:
+        query_result = lib.bibfmt.query("citekey", str(citekey))
+        if query_result and len(query_result) == 1:
+            result[citekey] = dict(lib.read_entry(query_result[0]))
+        else:
+            result[citekey] = None
 
-    return bottle.template(DEFAULT_REPONSE_HTML,
-                           title="{} @ {}".format(bibfile.name, keywords),
-                           lines=lines)
+    return result
+
+@bottle.route("/api/keywords/<keywords>")
+def index(keywords):
+    lib = get_library()
+    check_library_modified(lib)
+
+    try:
+        query_result = keywords_query(lib, keywords)
+    except QueryError as e:
+        return api_error(400, "Invalid query: {}".format(e))
+
+    try:
+        offset = max(0, int(bottle.request.query.get("offset", 0)))
+        limit = int(bottle.request.query.get("limit", 0))
+    except ValueError:
+        return api_error(400, "Invalid offset or limit.")
+
+    if limit <= 0:
+        limit = len(query_result)
+
+    return {"total": len(query_result),
+            "offset": offset,
+            "entries": [dict(lib.read_entry(filepos))
+                        for filepos in query_result[offset:offset + limit]]}
+
+@bottle.route("/api/search")
+def index():
+    lib = get_library()
+    check_library_modified(lib)
+
+    weights = search_weights()
+    if weights is None:
+        return api_error(400, "Invalid fields: {}".format(bottle.request.query.fields))
+
+    query_result = text_query(lib.bibfmt, weights, bottle.request.query.get("q", ""))
+
+    try:
+        offset = max(0, int(bottle.request.query.get("offset", 0)))
+        limit = int(bottle.request.query.get("limit", 0))
+    except ValueError:
+        return api_error(400, "Invalid offset or limit.")
+
+    if limit <= 0:
+        limit = len(query_result)
+
+    entries = []
+    for score, filepos in query_result[offset:offset + limit]:
+        entry = dict(lib.read_entry(filepos))
+        entry["score"] = score
+        entries.append(entry)
+
+    return {"total": len(query_result), "offset": offset, "entries": entries}
+
+class ThreadPoolServer(bottle.ServerAdapter):
+    """
+    Server based on wsgiref, handling requests concurrently in a pool of
+    'workers' threads.
+    """
+    def run(self, app):
+        from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+        executor = ThreadPoolExecutor(max_workers=self.options.get("workers", 8))
+
+        class PoolWSGIServer(WSGIServer):
+            if ":" in self.host:
+                address_family = socket.AF_INET6
+
+            def process_request(self, request, client_address):
+                executor.submit(self.process_request_thread, request, client_address)
+
+            def process_request_thread(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+        server = make_server(self.host, int(self.port), app, PoolWSGIServer,
+                             WSGIRequestHandler)
+        try:
+            server.serve_forever()
+        finally:
+            executor.shutdown(wait=False)
+
+# Servers in addition to those supported by bottle.
+SERVERS = {"threaded": ThreadPoolServer}
+
+# Name of the option to pass the number of workers with, for servers
+# supporting it.
+SERVER_WORKERS_OPTION = {"threaded": "workers",
+                         "gunicorn": "workers",
+                         "waitress": "threads"}
 
 def main(conf):
     global bibfmt_module
@@ -151,9 +645,11 @@ def main(conf):
         return 1
 
     try:
-        global bibfmt
-        bibfmt = bibfmt_module.BibFmt(bibfile)
-        bibfmt.build_index('citekey', 'keywords')
+        global webserve_conf, library
+        webserve_conf = conf
+        library = Library(conf, bibfile, conf.args.preload)
+        # Start watching; server processes forked later start their own.
+        get_library()
 
         if conf.args.listen.startswith('['):
             # IPv6
@@ -162,7 +658,17 @@ def main(conf):
             port = listen[1]
         else:
             host, port = conf.args.listen.split(":")
-        bottle.run(host=host, port=port)
+
+        server_options = {}
+        if conf.args.workers is not None:
+            if conf.args.server not in SERVER_WORKERS_OPTION:
+                logging.critical("Server does not support --workers: {}".format(
+                    conf.args.server))
+                return 1
+            server_options[SERVER_WORKERS_OPTION[conf.args.server]] = conf.args.workers
+
+        bottle.run(server=SERVERS.get(conf.args.server, conf.args.server),
+                   host=host, port=port, **server_options)
     finally:
         bibfile.close()
 
@@ -170,5 +676,22 @@ def register_args(parser):
     parser.add_argument("-l", "--listen", type=str,
             dest="listen", default="localhost:8080",
             help="Which address and socket to listen on. [Default:localhost:8080]")
+    parser.add_argument("--server", metavar="SERVER", type=str,
+            dest="server", default="wsgiref",
+            help="Server to use: 'threaded' (thread pool), or any server "
+                 "supported by bottle, e.g. 'gunicorn' (multiple processes) "
+                 "or 'waitress'. [Default:wsgiref]")
+    parser.add_argument("--workers", metavar="N", type=int,
+            dest="workers", default=None,
+            help="Number of worker threads or processes of the server.")
+    parser.add_argument("--reload-interval", metavar="SECONDS", type=float,
+            dest="reload_interval", default=2,
+            help="Interval to check the bibliography file for changes at; 0 to disable. [Default:2]")
+    parser.add_argument("--page-size", metavar="N", type=int,
+            dest="page_size", default=100,
+            help="Number of entries per page of keyword results; 0 for all. [Default:100]")
+    parser.add_argument("--preload", action="store_true",
+            dest="preload", default=False,
+            help="Load all entries into memory at startup, and cache rendered entries.")
     parser.set_defaults(func=main)
 
@@ -0,0 +1,231 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bibliography store: BibTeX entries in an SQLite database, with the indices
+kept up to date on every write. Unlike with the bibtex format, the file never
+needs to be scanned, and queries read only the matching entries; use the
+convert command to import from or export to BibTeX.
+
+Entries are stored as their BibTeX text, and are identified by their row id,
+which takes the place of the file offset in the bibtex format. Row ids are
+assigned in increasing order, so that appended entries sort last.
+"""
+
+import copy
+import logging
+
+from bibman.formats import bibtex
+from bibman.formats.bibtex import KEYWORDS, FILE, HASH, CITEKEY, YEAR, \
+        TEXT_FIELDS, QUERY_FIELDS, UNIQUE_INDICES, TEMPLATE_PLAIN, Entry, \
+        ParseError, parse_entry, decode_value, rewrite_entry
+from bibman.sqlindex import Database, PostingsIndex, add_postings, \
+        remove_postings, SCHEMA as INDEX_SCHEMA
+from bibman.util import tokenize
+
+STORE_VERSION = 1
+
+SCHEMA = INDEX_SCHEMA + """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    raw BLOB NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+"""
+
+# Maximum number of entries read per statement by read_entries.
+READ_BATCH_SIZE = 500
+
+def entry_postings(entry, filepos):
+    """
+    Returns generator of (field, key, filepos) of the entry in all indices;
+    keys are as in the indices built by the bibtex format, which does not
+    index entries without cite-key (@string and @preamble).
+    """
+    if entry.get(CITEKEY) is None:
+        return
+
+    yield CITEKEY, entry[CITEKEY], filepos
+
+    if KEYWORDS in entry:
+        for keyword in set(entry[KEYWORDS].split(",")):
+            keyword = keyword.strip()
+            if len(keyword) != 0:
+                yield KEYWORDS, keyword, filepos
+
+    for field in (YEAR, FILE, HASH):
+        if field in entry:
+            yield field, entry[field], filepos
+
+    for field in TEXT_FIELDS:
+        if field in entry:
+            for word in set(tokenize(entry[field])):
+                yield field, word, filepos
+
+class BibFmt(bibtex.BibFmt):
+    """
+    Implements the interface of bibtex.BibFmt on a bibliography store; new
+    entries are formatted as in the bibtex format.
+    """
+    def __init__(self, bibfile, template=TEMPLATE_PLAIN, index_cache=True,
+                 index_jobs=1, index_db=False):
+        super().__init__(bibfile, template=template, index_cache=False)
+        self.database = Database(bibfile.name, STORE_VERSION, schema=SCHEMA,
+                                 readonly=not bibfile.writable())
+        self.generation = None
+
+    def _write(self, func, *args):
+        """
+        Calls func(db, *args) in a transaction, which also bumps the
+        generation if func returns True.
+        """
+        def write(db):
+            if func(db, *args):
+                db.execute(
+                    "UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+        self.database.transaction(write)
+
+    def _generation(self):
+        return self.database.execute(
+                "SELECT value FROM meta WHERE key = 'generation'")[0][0]
+
+    def _end_id(self):
+        return self.database.execute(
+                "SELECT IFNULL(MAX(id), 0) + 1 FROM entries")[0][0]
+
+    def build_index(self, *toindex):
+        # All indices are kept up to date in the store.
+        for index in set(toindex) | {CITEKEY}:
+            self.index[index] = PostingsIndex(self.database, index,
+                                              index in UNIQUE_INDICES)
+
+        self.generation = self._generation()
+        # See bibtex.BibFmt.scan_state; only the position is used, which is
+        # the id of the next entry.
+        self.scan_state = (self._end_id(), False, 0)
+
+        self._warn_duplicates()
+
+    def updated(self):
+        """
+        Returns a new BibFmt for the same store, if entries were only appended
+        since the index was built; returns None if entries were changed.
+        """
+        if self.generation is None or self._generation() != self.generation:
+            return None
+
+        result = copy.copy(self)
+        result.index = dict(self.index)
+        result.scan_state = (result._end_id(), False, 0)
+        return result
+
+    def flush_index(self):
+        pass
+
+    def _read_entry_bytes(self, filepos):
+        rows = self.database.execute("SELECT raw FROM entries WHERE id = ?",
+                                     (filepos,))
+        return rows[0][0] if len(rows) != 0 else b""
+
+    def read_entry(self, filepos):
+        return Entry(self._read_entry_bytes(filepos), filepos, self._encoding())
+
+    def read_entries(self, offsets):
+        offsets = sorted(offsets)
+        encoding = self._encoding()
+
+        for i in range(0, len(offsets), READ_BATCH_SIZE):
+            batch = offsets[i:i + READ_BATCH_SIZE]
+            rows = dict(self.database.execute(
+                    "SELECT id, raw FROM entries WHERE id IN ({})".format(
+                        ",".join("?" * len(batch))), batch))
+            for filepos in batch:
+                if filepos in rows:
+                    yield Entry(rows[filepos], filepos, encoding)
+
+    def read_all_entries(self):
+        return self.read_entries([row[0] for row in self.database.execute(
+                "SELECT id FROM entries")])
+
+    def _encoding(self):
+        return "utf-8"
+
+    def append_entries(self, entries):
+        def insert(db):
+            for entry in entries:
+                if not isinstance(entry, Entry):
+                    entry = Entry(entry.encode(self._encoding()))
+
+                filepos = db.execute("INSERT INTO entries (raw) VALUES (?)",
+                                     (bytes(entry.raw),)).lastrowid
+                add_postings(db, entry_postings(entry, filepos))
+                count[0] += 1
+            return False
+
+        count = [0]
+        self._write(insert)
+
+        if len(self.index) != 0:
+            self.scan_state = (self._end_id(), False, 0)
+        return count[0]
+
+    def update_in_place(self, filepos, key, old_val, value):
+        """
+        Replaces the value old_val of field key of the entry with value; the
+        length of the value is not limited, unlike in the bibtex format.
+        """
+        raw = self._read_entry_bytes(filepos)
+        try:
+            parsed = parse_entry(raw, raw.find(b"@"), encoding=self._encoding())
+        except ParseError as e:
+            logging.error("Could not update entry {}: {}".format(filepos, e))
+            return False
+
+        span = parsed.fields.get(key)
+        if span is None or decode_value(raw, span) != old_val:
+            return False
+
+        return self.rewrite({filepos: {key: value}})
+
+    def rewrite(self, edits):
+        """
+        Applies edits as bibtex.BibFmt.rewrite, in one transaction; ids of
+        entries do not change.
+        """
+        def apply(db):
+            for filepos, changes in edits.items():
+                row = db.execute("SELECT raw FROM entries WHERE id = ?",
+                                 (filepos,)).fetchone()
+                if row is None:
+                    raise ParseError("No entry with id {}".format(filepos))
+
+                # Postings are not indexed by entry, to keep the store small;
+                # remove those of the old entry by key.
+                remove_postings(db, entry_postings(Entry(row[0], filepos), filepos))
+
+                if changes is None:
+                    db.execute("DELETE FROM entries WHERE id = ?", (filepos,))
+                else:
+                    raw = rewrite_entry(row[0], changes, self._encoding())
+                    db.execute("UPDATE entries SET raw = ? WHERE id = ?", (raw, filepos))
+                    add_postings(db, entry_postings(Entry(raw, filepos), filepos))
+            return True
+
+        try:
+            self._write(apply)
+        except ParseError as e:
+            logging.error("Could not rewrite '{}': {}".format(self.bibfile.name, e))
+            return False
+        return True
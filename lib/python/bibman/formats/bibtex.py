@@ -13,21 +13,48 @@
 # limitations under the License.
 
 """
-Simple operations on BibTeX file, assuming the format as outlined in
-TEMPLATE_*. Trading off a full parser for speed; for my usecase, this
-implementation is sufficient.
+Operations on BibTeX files. Entries in the format outlined in TEMPLATE_* are
+indexed by a fast line-based scan; other entries, and @string definitions,
+are handled by a parser of the full BibTeX syntax.
 """
 
-# TODO: Use proper BibTeX parser for this?
-
 from string import Template
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+import bisect
+import collections
+import collections.abc
+import copy
+import functools
+import hashlib
+import mmap
+import os
+import re
 import pprint
 import logging
+import sqlite3
+import sys
+
+from bibman.util import load_pickle, dump_pickle_atomic, tokenize, CACHE_DIR, \
+        HASH_BLOCK_SIZE
+from bibman.sqlindex import Database, PostingsIndex, get_meta, set_meta, \
+        add_postings, remove_postings, index_postings
 
 KEYWORDS = "keywords"
 FILE     = "file"
 HASH     = "md5"
 CITEKEY  = "citekey"
+YEAR     = "year"
+
+# Fields with full-text indices: map words (see util.tokenize) to entries.
+AUTHOR     = "author"
+TITLE      = "title"
+JOURNAL    = "journal"
+ANNOTATION = "annotation"
+TEXT_FIELDS = (AUTHOR, TITLE, JOURNAL, ANNOTATION)
+
+# Indices which may be queried by field (see querylang).
+QUERY_FIELDS = (CITEKEY, KEYWORDS, YEAR, FILE, HASH) + TEXT_FIELDS
 
 # The '   ' after closing '}', is a simple way to enable folding in your
 # favorite editor. For VIM that would be: foldmarker=@,}\ \ \ 
@@ -46,26 +73,337 @@ TEMPLATE_PLAIN = Template("""@${reftype}{${citekey},
 TEMPLATE_TOP_ALLOW = ["journal", "number", "pages", "publisher", "volume"]
 TEMPLATE_BOTTOM_ALLOW = ["md5"]
 
-def convert_to_dict(entry_string):
-    if entry_string[0] != "@": return {}
+# Values of the file field are padded with spaces to this length, so that
+# moved files can be updated in place (see BibFmt.update_in_place).
+FILE_PADDING = 128
 
-    try:
-        braces = entry_string.index("{")
-        comma = entry_string.index(",")
+# Index cache: the index is stored in a file in the user's cache directory,
+# named by the hash of the path of the bibliography, and only used if path,
+# size and mtime still match, or if the fingerprint of the indexed prefix
+# matches and entries were only appended. The cache is a
+# pickle, and must not be kept where others can write it (e.g. next to a
+# shared bibliography), since loading it may run arbitrary code.
+INDEX_CACHE_VERSION = 6
+INDEX_CACHE_DIR = os.path.join(CACHE_DIR, "index")
+
+# Index database: alternative to the index cache, for large bibliographies.
+# The indices are kept in an SQLite database next to the bibliography, and
+# are queried there instead of being loaded; entries appended to the
+# bibliography are indexed incrementally, as with the cache.
+INDEX_DB_VERSION = 1
+INDEX_DB_FORMAT = ".{}.bibman-index.sqlite"
+
+def index_cache_path(path):
+    name = hashlib.md5(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(os.path.expanduser(INDEX_CACHE_DIR), name)
+
+def index_db_path(path):
+    dirname, basename = os.path.split(os.path.abspath(path))
+    return os.path.join(dirname, INDEX_DB_FORMAT.format(basename))
+
+def gen_fingerprint(f, size):
+    """
+    Content fingerprint of the first size bytes of the binary file f: the MD5
+    digest of the whole prefix, so that edits anywhere in it are detected.
+    """
+    md5 = hashlib.md5()
+    md5.update(str(size).encode())
+    buf = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(buf)
+
+    f.seek(0, 0)
+    while size > 0:
+        n = f.readinto(view[:min(size, HASH_BLOCK_SIZE)])
+        if not n: break
+        md5.update(view[:n])
+        size -= n
+
+    return md5.hexdigest()
+
+# Streaming parser: unlike the line-based index_buffer, handles the full
+# BibTeX syntax, i.e. values with nested braces, quoted values, concatenation
+# with '#', multi-line values, and @string, @preamble and @comment entries.
+
+class ParseError(ValueError):
+    pass
+
+# An entry as parsed by parse_entry. fields maps lower-case field names to
+# the (start, end) span of their raw value in the buffer; use decode_value to
+# get the value.
+ParsedEntry = collections.namedtuple("ParsedEntry",
+                                     "start end reftype citekey fields")
+
+PARSE_ENTRY_RE = re.compile(rb"@[ \t]*([A-Za-z][\w-]*)\s*([{(])")
+PARSE_KEY_RE   = re.compile(rb"\s*([^\s,={}()\"#]*)")
+PARSE_FIELD_RE = re.compile(rb"\s*([^\s,={}()\"#]+)\s*=")
+# Field with a value without nested braces or concatenation, which is the
+# common case; matched at once, rather than piecewise.
+PARSE_SIMPLE_FIELD_RE = re.compile(
+        rb'[\s,]*([^\s,={}()"#]+)\s*=\s*(\{[^{}]*\}|"[^"{}]*"|[^\s,={}()"#]+)(?=\s*[,})])')
+PARSE_BARE_RE  = re.compile(rb"[^\s,={}()\"#]+")
+PARSE_WS_RE    = re.compile(rb"\s*")
+PARSE_BRACE_RE = re.compile(rb"[{}]")
+PARSE_QUOTE_RE = re.compile(rb'[{}"]')
+WRAPPED_NEWLINE_RE = re.compile(r"\s*\n\s*")
+
+def _skip_braced(buf, pos, end):
+    """
+    Returns position after the brace matching the one at pos.
+    """
+    # Fast path for values without nested braces.
+    close = buf.find(b"}", pos + 1, end)
+    if close >= 0 and buf.find(b"{", pos + 1, close) < 0:
+        return close + 1
+
+    depth = 0
+    for m in PARSE_BRACE_RE.finditer(buf, pos, end):
+        if m.group() == b"{":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return m.end()
+    raise ParseError("Unbalanced braces at offset {}".format(pos))
+
+def _skip_quoted(buf, pos, end):
+    """
+    Returns position after the quote ending the quoted value at pos; quotes
+    within braces do not end it.
+    """
+    depth = 0
+    for m in PARSE_QUOTE_RE.finditer(buf, pos + 1, end):
+        c = m.group()
+        if c == b"{":
+            depth += 1
+        elif c == b"}":
+            depth -= 1
+        elif depth == 0:
+            return m.end()
+    raise ParseError("Unterminated quote at offset {}".format(pos))
+
+def _value_pieces(buf, pos, end):
+    """
+    Returns generator of (start, end, kind) of the pieces of a value at pos,
+    concatenated with '#'; kind is the first byte of the piece. Stops after
+    the last piece, which is the position returned by StopIteration.value.
+    """
+    while True:
+        pos = PARSE_WS_RE.match(buf, pos, end).end()
+        kind = buf[pos:pos + 1]
+        if kind == b"{":
+            piece_end = _skip_braced(buf, pos, end)
+        elif kind == b'"':
+            piece_end = _skip_quoted(buf, pos, end)
+        else:
+            m = PARSE_BARE_RE.match(buf, pos, end)
+            if m is None:
+                raise ParseError("Expected value at offset {}".format(pos))
+            piece_end = m.end()
+
+        yield pos, piece_end, kind
+
+        pos = PARSE_WS_RE.match(buf, piece_end, end).end()
+        if buf[pos:pos + 1] != b"#":
+            return piece_end
+        pos += 1
+
+def parse_value(buf, pos, end):
+    """
+    @return (start, end) span of the value at pos.
+    """
+    # Fast path for a single braced value.
+    pos = PARSE_WS_RE.match(buf, pos, end).end()
+    if buf[pos:pos + 1] == b"{":
+        value_end = _skip_braced(buf, pos, end)
+        next_pos = PARSE_WS_RE.match(buf, value_end, end).end()
+        if buf[next_pos:next_pos + 1] != b"#":
+            return pos, value_end
+
+    start = None
+    for piece_start, piece_end, _ in _value_pieces(buf, pos, end):
+        if start is None:
+            start = piece_start
+    return start, piece_end
+
+def parse_entry(buf, pos, end=None, encoding="utf-8"):
+    """
+    Parses the entry beginning with '@' at pos.
+
+    @return ParsedEntry; for @string entries, fields are the defined strings.
+    @raise ParseError if the entry is malformed.
+    """
+    end = len(buf) if end is None else end
+
+    m = PARSE_ENTRY_RE.match(buf, pos, end)
+    if m is None:
+        raise ParseError("Expected entry at offset {}".format(pos))
+
+    reftype = m.group(1).decode(encoding)
+    close = b"}" if m.group(2) == b"{" else b")"
+    kind = reftype.lower()
+    citekey = None
+    fields = {}
+
+    if kind == "comment":
+        entry_end = _skip_braced(buf, m.end() - 1, end) if close == b"}" \
+                else buf.find(b")", m.end(), end) + 1
+        if entry_end <= 0:
+            raise ParseError("Unterminated comment at offset {}".format(pos))
+        return ParsedEntry(pos, entry_end, reftype, None, fields)
+
+    cur = m.end()
+    if kind == "preamble":
+        fields[kind] = parse_value(buf, cur, end)
+        cur = fields[kind][1]
+    elif kind != "string":
+        km = PARSE_KEY_RE.match(buf, cur, end)
+        citekey = km.group(1).decode(encoding)
+        cur = km.end()
+
+    while True:
+        fm = PARSE_SIMPLE_FIELD_RE.match(buf, cur, end)
+        if fm is not None:
+            fields[fm.group(1).decode(encoding).lower()] = fm.span(2)
+            cur = fm.end()
+            continue
 
-        result = {}
-        result["reftype"] = entry_string[1:braces]
-        result["citekey"] = entry_string[braces+1:comma]
+        cur = PARSE_WS_RE.match(buf, cur, end).end()
+        c = buf[cur:cur + 1]
+        if c == b",":
+            cur += 1
+        elif c == close:
+            return ParsedEntry(pos, cur + 1, reftype, citekey, fields)
+        else:
+            fm = PARSE_FIELD_RE.match(buf, cur, end)
+            if fm is None:
+                raise ParseError("Expected field at offset {}".format(cur))
+            span = parse_value(buf, fm.end(), end)
+            fields[fm.group(1).decode(encoding).lower()] = span
+            cur = span[1]
 
-        entry_string = entry_string[comma+1:].strip(". \n{}")
-        elements = entry_string.split("},")
-        if len(elements) == 1:
-            entry_string.split("\",")
+def parse_entries(buf, pos=0, end=None, encoding="utf-8"):
+    """
+    Returns generator of ParsedEntry for all entries in buf from pos up to
+    end, except comments. Text outside of entries is ignored, as by BibTeX;
+    malformed entries are skipped with a warning.
+    """
+    end = len(buf) if end is None else end
 
-        for element in elements:
-            key_val = element.split("=")
-            if len(key_val) >= 2:
-                result[key_val[0].strip()] = key_val[1].strip(" \n{}\"")
+    while True:
+        pos = buf.find(b"@", pos, end)
+        if pos < 0:
+            return
+
+        if PARSE_ENTRY_RE.match(buf, pos, end) is None:
+            # Not an entry, e.g. an address in a comment.
+            pos += 1
+            continue
+
+        try:
+            entry = parse_entry(buf, pos, end, encoding)
+        except ParseError as e:
+            logging.warning("Skipping malformed entry: {}".format(e))
+            pos += 1
+            continue
+
+        pos = entry.end
+        if entry.reftype.lower() != "comment":
+            yield entry
+
+# Text after the closing brace of an entry up to the end of its line.
+ENTRY_TRAIL_RE = re.compile(rb"[ \t]*\r?\n?")
+
+def find_entry(buf, pos, end=None, encoding="utf-8"):
+    """
+    Parses the entry at pos, which must end before the next line beginning
+    with '@'.
+
+    @return (ParsedEntry, end), where end is the end of the entry including
+            the rest of its last line, if blank.
+    @raise ParseError if the entry is malformed.
+    """
+    end = len(buf) if end is None else end
+    bound = buf.find(b"\n@", pos + 1, end)
+    entry = parse_entry(buf, pos, end if bound < 0 else bound + 1, encoding)
+    return entry, ENTRY_TRAIL_RE.match(buf, entry.end, end).end()
+
+def _is_wrapped(value):
+    """
+    Returns True if value is enclosed in a pair of matching braces.
+    """
+    if len(value) < 2 or value[0] != "{" or value[-1] != "}":
+        return False
+    if value.count("{") == 1:
+        return True
+
+    depth = 0
+    for i, c in enumerate(value):
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return i == len(value) - 1
+    return False
+
+def decode_value(buf, span, macros=None, encoding="utf-8"):
+    """
+    Returns value with the given span (see parse_value) as string: pieces
+    are concatenated without delimiters, strings defined in macros (lower-case
+    name to value) are substituted, and line breaks are replaced by a space.
+    Braces enclosing the whole value (e.g. to protect case) are removed.
+    """
+    start, end = span
+    if buf[start:start + 1] == b"{" and (buf.find(b"#", start, end) < 0 or
+                                        _skip_braced(buf, start, end) == end):
+        # Fast path for a single braced value.
+        value = bytes(buf[start + 1:end - 1]).decode(encoding)
+    else:
+        value = "".join(_decode_pieces(buf, span, macros, encoding))
+
+    while _is_wrapped(value):
+        value = value[1:-1]
+
+    if "\n" in value:
+        value = WRAPPED_NEWLINE_RE.sub(" ", value)
+    return value.strip()
+
+def _decode_pieces(buf, span, macros, encoding):
+    parts = []
+    for start, end, kind in _value_pieces(buf, span[0], span[1]):
+        if kind == b"{" or kind == b'"':
+            parts.append(bytes(buf[start + 1:end - 1]).decode(encoding))
+        else:
+            name = bytes(buf[start:end]).decode(encoding)
+            parts.append(macros.get(name.lower(), name) if macros else name)
+    return parts
+
+def _uses_macros(buf, span):
+    """
+    Returns True if the value with the given span may refer to strings (see
+    decode_value).
+    """
+    start, end = span
+    if buf[start:start + 1] in (b"{", b'"'):
+        return buf.find(b"#", start, end) >= 0
+    return not buf[start:end].isdigit()
+
+def entry_to_dict(buf, entry, macros=None, encoding="utf-8"):
+    """
+    @return Dict of the fields of ParsedEntry entry, including its reftype
+            and citekey.
+    """
+    result = {"reftype": entry.reftype, "citekey": entry.citekey}
+    for name, span in entry.fields.items():
+        result[name] = decode_value(buf, span, macros, encoding)
+    return result
+
+def convert_to_dict(entry_string):
+    if entry_string[0] != "@": return {}
+
+    try:
+        buf = entry_string.encode("utf-8")
+        result = entry_to_dict(buf, parse_entry(buf, 0))
 
         if logging.getLogger().isEnabledFor(logging.DEBUG):
             pp = pprint.PrettyPrinter(indent=4)
@@ -78,111 +416,1023 @@ def convert_to_dict(entry_string):
             entry_string, e))
         return {}
 
+class Entry(collections.abc.Mapping):
+    """
+    Read-only mapping of field names to values of an entry, as returned by
+    convert_to_dict, backed by the raw bytes of the entry. The entry is only
+    parsed on first access, and values are decoded on access and cached;
+    use dict(entry) to decode all fields.
+
+    macros is None, or a function returning the strings defined in the
+    bibliography (see read_macros), which is only called if a value refers to
+    one.
+    """
+    __slots__ = ("filepos", "raw", "encoding", "macros", "_parsed", "_values")
+
+    def __init__(self, raw, filepos=None, encoding="utf-8", macros=None):
+        self.filepos = filepos
+        self.raw = raw
+        self.encoding = encoding
+        self.macros = macros
+        self._parsed = None
+        self._values = None
+
+    def _parse(self):
+        if self._parsed is None:
+            try:
+                self._parsed = parse_entry(self.raw, self.raw.find(b"@"),
+                                           encoding=self.encoding)
+            except ParseError as e:
+                logging.error("(formats/bibtex) Entry at {}: {}".format(
+                    self.filepos, e))
+                self._parsed = ParsedEntry(0, len(self.raw), None, None, {})
+        return self._parsed
+
+    def __getitem__(self, name):
+        if self._values is None:
+            self._values = {}
+        elif name in self._values:
+            return self._values[name]
+
+        parsed = self._parse()
+        if name == "reftype" and parsed.reftype is not None:
+            value = parsed.reftype
+        elif name == "citekey" and parsed.citekey is not None:
+            value = parsed.citekey
+        else:
+            span = parsed.fields[name]
+            macros = None
+            if self.macros is not None and _uses_macros(self.raw, span):
+                macros = self.macros()
+            value = decode_value(self.raw, span, macros, self.encoding)
+
+        self._values[name] = value
+        return value
+
+    def __contains__(self, name):
+        parsed = self._parse()
+        if name == "reftype" or name == "citekey":
+            return getattr(parsed, name) is not None
+        return name in parsed.fields
+
+    def __iter__(self):
+        parsed = self._parse()
+        if parsed.reftype is not None:
+            yield "reftype"
+        if parsed.citekey is not None:
+            yield "citekey"
+        yield from parsed.fields
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def text(self):
+        """
+        @return Raw text of the entry.
+        """
+        return self.raw.decode(self.encoding)
+
+def make_entry(buf, parsed, end, encoding="utf-8", macros=None):
+    """
+    @return Entry of ParsedEntry parsed in buf, which ends at end (see
+            find_entry); the entry is not parsed again.
+    """
+    start = parsed.start
+    entry = Entry(bytes(buf[start:end]), start, encoding, macros)
+    entry._parsed = ParsedEntry(0, parsed.end - start, parsed.reftype, parsed.citekey,
+                                {name: (span[0] - start, span[1] - start)
+                                 for name, span in parsed.fields.items()})
+    return entry
+
+def read_entry_at(buf, pos, encoding="utf-8", macros=None):
+    """
+    @return Entry at pos of buf, which ends at the brace matching its opening
+            brace (and the rest of the line, if blank); a malformed entry is
+            read up to the next line beginning with '@'.
+    """
+    bound = buf.find(b"\n@", pos + 1) + 1
+    if bound == 0:
+        bound = len(buf)
+
+    # Fast path for entries ending with a closing line (see ENTRY_CLOSE), as
+    # in the templates, which are only parsed on access.
+    m = ENTRY_CLOSE_RE.search(buf, pos, bound)
+    if m is not None:
+        raw = bytes(buf[pos:m.end()])
+        if raw.count(b"{") == raw.count(b"}"):
+            return Entry(raw, pos, encoding, macros)
+
+    try:
+        return make_entry(buf, *find_entry(buf, pos, bound, encoding),
+                          encoding=encoding, macros=macros)
+    except ParseError:
+        return Entry(bytes(buf[pos:bound]), pos, encoding, macros)
+
+# Text from the beginning of the line of a field up to its value.
+FIELD_PREFIX_RE = re.compile(rb"[ \t]*[^\s,={}()\"#]+[ \t]*=[ \t]*")
+# Text after the value of a field up to the end of its line.
+FIELD_SUFFIX_RE = re.compile(rb"[ \t]*,?[ \t]*\r?\n?")
+# Same, if the value is last on its line; group 1 is the comma, and group 2
+# the padding (see FILE_PADDING).
+FIELD_LINE_END_RE = re.compile(rb"[ \t]*(,?)([ \t]*)(?=\r?\n)")
+
+def rewrite_entry(raw, changes, encoding="utf-8"):
+    """
+    Returns raw text (bytes) of an entry with fields changed; the rest of the
+    text is kept as is, except for padding after changed values, which is
+    made to fit the new value (see FILE_PADDING).
+
+    @param changes Dict of field name to new value, or None to remove the
+                   field; fields not in the entry are added at its end.
+    @raise ParseError if the entry is malformed, or a field to be removed is
+           not on a line of its own.
+    """
+    entry = parse_entry(raw, raw.find(b"@"), encoding=encoding)
+
+    # (start, end, replacement) of the edits, not overlapping.
+    edits = []
+    added = []
+    removed = set()
+    for name, value in changes.items():
+        span = entry.fields.get(name.lower())
+        if span is None:
+            if value is not None:
+                added.append("  {} = {{{}}},\n".format(name, value))
+        elif value is not None:
+            text = "{{{}}}".format(value).encode(encoding)
+            end = span[1]
+            m = FIELD_LINE_END_RE.match(raw, end)
+            if m is not None and m.group(2):
+                # Replace the padding of the old value.
+                text += m.group(1)
+                if name.lower() == FILE:
+                    text += b" " * max(0, FILE_PADDING - len(value))
+                end = m.end()
+            edits.append((span[0], end, text))
+        else:
+            line_start = raw.rfind(b"\n", 0, span[0]) + 1
+            if FIELD_PREFIX_RE.fullmatch(raw, line_start, span[0]) is None:
+                raise ParseError("Field '{}' not on a line of its own at offset {}".format(
+                    name, span[0]))
+            edits.append((line_start, FIELD_SUFFIX_RE.match(raw, span[1]).end(), b""))
+            removed.add(name.lower())
+
+    if len(added) != 0:
+        close = entry.end - 1
+        kept = [end for name, (_, end) in entry.fields.items() if name not in removed]
+        if len(kept) != 0:
+            # The field before the added ones needs a separating comma.
+            last_end = max(kept)
+            pos = PARSE_WS_RE.match(raw, last_end, close).end()
+            if raw[pos:pos + 1] != b",":
+                edits.append((last_end, last_end, b","))
+
+        text = "".join(added).encode(encoding)
+        line_start = raw.rfind(b"\n", 0, close) + 1
+        if raw[line_start:close].strip() == b"":
+            edits.append((line_start, line_start, text))
+        else:
+            edits.append((close, close, b"\n" + text))
+
+    for start, end, replacement in sorted(edits, key=lambda edit: edit[:2], reverse=True):
+        raw = raw[:start] + replacement + raw[end:]
+    return raw
+
+# Matches lines in ENTRY_CLOSE.
+ENTRY_CLOSE_RE = re.compile(rb"^\}(?:   )?\n", re.MULTILINE)
+
+READ_BLOCK_SIZE = 4096
+
+# Size of the blocks in which unchanged parts of the file are copied by
+# BibFmt.rewrite.
+REWRITE_BLOCK_SIZE = 1 << 20
+
+# Size of the chunks in which the file is scanned by index_buffer; bounds the
+# memory used for intermediate match results.
+INDEX_CHUNK_SIZE = 1 << 23
+
+# Indices mapping each key to a single entry; all other indices map keys to
+# posting lists: sorted arrays of offsets (see add_posting).
+UNIQUE_INDICES = (FILE, HASH)
+
+POSTING_TYPECODE = "Q"
+
+# Fields which may be indexed by index_buffer, apart from the cite-key.
+INDEX_FIELDS = (KEYWORDS, YEAR, FILE, HASH) + TEXT_FIELDS
+
+# Minimum size of the part of the file to index, for which parallel index
+# building is used; for smaller files, the serial scan is faster.
+PARALLEL_INDEX_MIN_SIZE = 1 << 25
+
+# Entries which are not indexed: @string, @comment and @preamble.
+SPECIAL_ENTRY = rb"[ \t]*((?i:string|comment|preamble))[ \t]*[{(]"
+
+ENTRY_START_RE = re.compile(rb"\n@(?!" + SPECIAL_ENTRY + rb")[^{\n]*\{")
+
+@functools.lru_cache()
+def index_line_re(fields):
+    """
+    Returns regex matching the lines relevant for indexing the given fields:
+    entry start (with the rest of the line after the cite-key), entry close
+    (see ENTRY_CLOSE), the field lines (with the rest of the line as value)
+    and the start of special entries (see SPECIAL_ENTRY). All alternatives begin with the preceding newline, which
+    the regex engine can search for quickly, and all other lines are skipped.
+    """
+    if len(fields) != 0:
+        rest = rb"([^\n]*)"
+        close = rb"(\})(?:   )?\r?(?=\n)"
+        field = rb"[ \t]*(" + b"|".join(f.encode() for f in fields) + \
+                rb")[ \t]*=([^\n]*)"
+    else:
+        # Only cite-keys are indexed; let other alternatives fail.
+        rest = rb"()"
+        close = rb"(?!)()"
+        field = rb"(?!)()()"
+
+    # Special entries match with the name of their type, rather than the
+    # cite-key; an alternative of their own would slow down the scan.
+    return re.compile(rb"\n(?:(@)(?:" + SPECIAL_ENTRY + rb"|[^{\n]*\{([^,\n]*)" +
+                      rest + rb")|" + close + b"|" + field + b")")
+
+def add_posting(entries, key, filepos):
+    """
+    Adds filepos to the posting list of key. Keys with a single entry map to
+    the bare offset, and are converted to an array on the second entry; this
+    avoids the overhead of a container for the many keys (e.g. cite-keys)
+    with a single entry. Keys are interned, to share them between indices.
+    """
+    postings = entries.get(key)
+    if postings is None:
+        entries[sys.intern(key)] = filepos
+    elif type(postings) is int:
+        if postings != filepos:
+            entries[key] = array(POSTING_TYPECODE, (postings, filepos))
+    elif postings[-1] != filepos:
+        postings.append(filepos)
+
+def insert_posting(entries, key, filepos):
+    """
+    Adds filepos to the posting list of key, as add_posting, but at its
+    position in the sorted list.
+    """
+    postings = entries.get(key)
+    if postings is None:
+        entries[sys.intern(key)] = filepos
+    elif type(postings) is int:
+        if postings != filepos:
+            entries[key] = array(POSTING_TYPECODE, sorted((postings, filepos)))
+    else:
+        i = bisect.bisect_left(postings, filepos)
+        if i == len(postings) or postings[i] != filepos:
+            postings.insert(i, filepos)
+
+def as_postings(value):
+    """
+    Returns sequence of offsets of a value of a posting list index (see
+    add_posting).
+    """
+    return (value,) if type(value) is int else value
+
+def add_field_postings(index, field, value, filepos):
+    """
+    Adds the entry at filepos to the dict in index for field, for its value.
+    """
+    if field == KEYWORDS:
+        for keyword in value.split(","):
+            add_posting(index[KEYWORDS], keyword.strip(), filepos)
+    elif field in UNIQUE_INDICES:
+        index[field][value] = filepos
+    elif field == YEAR:
+        add_posting(index[YEAR], value, filepos)
+    else:
+        for word in tokenize(value):
+            add_posting(index[field], word, filepos)
+
+# Start of an @string entry; see read_macros.
+STRING_ENTRY_RE = re.compile(rb"@[ \t]*(?i:string)[ \t]*[{(]")
+
+def read_macros(buf, encoding="utf-8"):
+    """
+    Returns dict of the strings defined by the @string entries in buf, which
+    begin at the beginning of a line (lower-case name to value; see
+    decode_value).
+    """
+    macros = {}
+    for m in STRING_ENTRY_RE.finditer(buf):
+        pos = m.start()
+        if pos != 0 and buf[pos - 1:pos] != b"\n":
+            continue
+
+        try:
+            entry, _ = find_entry(buf, pos, encoding=encoding)
+        except ParseError as e:
+            logging.warning("Could not parse entry: {}".format(e))
+            continue
+
+        for name, span in entry.fields.items():
+            macros[name] = decode_value(buf, span, macros, encoding)
+    return macros
+
+def index_entry(buf, pos, index, filepos, macros, encoding="utf-8"):
+    """
+    Adds the entry at pos in buf, at file offset filepos, to the dicts in
+    index for all its fields, by parsing the entry; used for entries which are
+    not in the format of the templates (see index_buffer). The cite-key is not
+    added.
+
+    @param macros Function returning the strings defined in buf (see
+                  read_macros); only called if a value refers to one.
+    @return False if the entry cannot be parsed.
+    """
+    try:
+        entry, _ = find_entry(buf, pos, encoding=encoding)
+    except ParseError as e:
+        logging.warning("Could not parse entry: {}".format(e))
+        return False
+
+    for name, span in entry.fields.items():
+        if name not in index or name not in INDEX_FIELDS:
+            continue
+
+        value = decode_value(buf, span, macros() if _uses_macros(buf, span) else None,
+                             encoding)
+
+        add_field_postings(index, name, value, filepos)
+    return True
+
+def _line_chunks(buf, pos, end, base):
+    """
+    Generates (chunk, chunk_base, start, stop) for the lines of buf from pos
+    up to end, in chunks of up to INDEX_CHUNK_SIZE: the lines are in chunk
+    from start up to stop, each preceded by its newline, and chunk[0] is at
+    file offset chunk_base.
+    """
+    if pos == 0:
+        # The first line has no preceding newline; prepend it to a copy.
+        first_end = buf.find(b"\n") + 1
+        yield b"\n" + buf[:first_end], base - 1, 0, first_end
+        pos = first_end
+
+    while pos < end:
+        # Chunk at line boundaries, starting at the newline before the line.
+        chunk_end = buf.rfind(b"\n", pos, min(end, pos + INDEX_CHUNK_SIZE))
+        if chunk_end < pos:
+            chunk_end = end - 1
+
+        yield buf, base, pos - 1, chunk_end
+        pos = chunk_end + 1
+
+def index_buffer(buf, index, scan_state, base=0, end=None, encoding="utf-8"):
+    """
+    Adds all entries of complete lines in buf, from the position in
+    scan_state up to end, to the dicts in index.
+
+    Entries in the format of the templates are indexed by their lines, which
+    is fast; entries with values which are not simple, single-line values, or
+    with fields on the line of the cite-key, are parsed instead.
+
+    @param buf Bytes-like object (e.g. mmap of the file); buf[0] is at file
+               offset base.
+    @param scan_state (position, valid_entry, last_entry_pos); position must be
+                      the beginning of a line.
+    @param end File offset to stop at; defaults to the end of buf.
+    @return New scan state.
+    """
+    pos, valid_entry, last_entry_pos = scan_state
+    pos -= base
+    end = len(buf) if end is None else end - base
+
+    # Only index complete lines.
+    end = buf.rfind(b"\n", pos, end) + 1
+    if end <= pos:
+        return scan_state
+
+    citekeys = index.get(CITEKEY)
+    keywords = index.get(KEYWORDS)
+    files = index.get(FILE)
+    hashes = index.get(HASH)
+    years = index.get(YEAR)
+    texts = {field.encode(): index[field] for field in TEXT_FIELDS if field in index}
+    line_re = index_line_re(tuple(f for f in INDEX_FIELDS if f in index))
+
+    # Strings defined in buf, only read if used by an entry.
+    macros = None
+    def get_macros():
+        nonlocal macros
+        if macros is None:
+            macros = read_macros(buf, encoding)
+        return macros
+
+    for chunk, chunk_base, start, stop in _line_chunks(buf, pos, end, base):
+        # findall is faster than finditer, but does not give positions; the
+        # entry starts are matched separately, in the same order.
+        entry_starts = iter([chunk_base + m.start() + 1 for m in
+                             ENTRY_START_RE.finditer(chunk, start, stop)])
+
+        for at, special, citekey, rest, close, field, value in \
+                line_re.findall(chunk, start, stop):
+            if at:
+                if special:
+                    valid_entry = False
+                    continue
+
+                valid_entry = True
+                last_entry_pos = next(entry_starts)
+
+                if citekeys is not None:
+                    citekey = citekey.decode(encoding)
+                    add_posting(citekeys, citekey, last_entry_pos)
+
+                if rest.strip(b" \t\r,"):
+                    # Fields on the line of the cite-key.
+                    if index_entry(buf, last_entry_pos - base, index,
+                                   last_entry_pos, get_macros, encoding):
+                        valid_entry = False
+
+            elif close:
+                valid_entry = False
+
+            elif valid_entry:
+                value = value.strip()
+                if value[:1] == b"{":
+                    simple = value.endswith((b"},", b"}")) and b"=" not in value
+                else:
+                    simple = value.rstrip(b",").isdigit()
+
+                if not simple:
+                    # Multi-line, quoted, or using strings, or possibly
+                    # followed by other fields on the same line: parse the
+                    # entry, and index all its fields at once.
+                    if index_entry(buf, last_entry_pos - base, index,
+                                   last_entry_pos, get_macros, encoding):
+                        valid_entry = False
+                    continue
+
+                value = value.strip(b" ,{}").decode(encoding)
+
+                # As add_field_postings, with the dicts bound to locals.
+                if field == b"keywords":
+                    for keyword in value.split(","):
+                        add_posting(keywords, keyword.strip(), last_entry_pos)
+                elif field == b"file":
+                    files[value] = last_entry_pos
+                elif field == b"md5":
+                    hashes[value] = last_entry_pos
+                elif field == b"year":
+                    add_posting(years, value, last_entry_pos)
+                else:
+                    words = texts[field]
+                    for word in tokenize(value):
+                        add_posting(words, word, last_entry_pos)
+
+    return (base + end, valid_entry, last_entry_pos)
+
+def index_file_chunk(path, toindex, scan_state, end, encoding):
+    """
+    Builds the given indices for the part of the file from the position in
+    scan_state up to end; used as worker for parallel index building.
+
+    @return (index, scan_state)
+    """
+    index = {name: {} for name in toindex}
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as buf:
+            scan_state = index_buffer(buf, index, scan_state, end=end,
+                                      encoding=encoding)
+
+    return index, scan_state
+
+def merge_index(index, other):
+    """
+    Merges other into index, where other was built for a part of the file
+    following the part index was built for. Posting lists in index are
+    replaced, not modified, so that they may be shared with other indices.
+    """
+    for name, entries in other.items():
+        target = index[name]
+        for key, filepos in entries.items():
+            if name not in UNIQUE_INDICES and key in target:
+                postings = array(POSTING_TYPECODE, as_postings(target[key]))
+                postings.extend(as_postings(filepos))
+                target[key] = postings
+            else:
+                target[key] = filepos
+
 class BibFmt:
-    def __init__(self, bibfile, template=TEMPLATE_PLAIN):
+    def __init__(self, bibfile, template=TEMPLATE_PLAIN, index_cache=True,
+                 index_jobs=1, index_db=False):
         self.bibfile = bibfile
         self.index = {}
         self.template = template
+        self.index_cache = index_cache
+        self.index_jobs = index_jobs or os.cpu_count() or 1
+        # Index database (see INDEX_DB_FORMAT) if used, opened on build_index.
+        self.use_index_db = index_db
+        self.index_db = None
+
+        # Scan state: (position, valid_entry, last_entry_pos) after the last
+        # indexed line; used to resume indexing of appended entries.
+        self.scan_state = (0, False, 0)
+        # See _indexed_state
+        self.indexed = None
+        self.index_dirty = False
+        # Sorted keys of indices, for query_prefix; built on demand.
+        self.sorted_keys = {}
+        # Strings defined in the bibfile; see _macros.
+        self.macros = None
+
+    def _open_by_path(self):
+        """
+        Opens the bibfile again by its path, in binary mode.
+
+        @raise OSError if the path now refers to another file than bibfile,
+               e.g. if the bibfile was replaced by rename.
+        """
+        f = open(self.bibfile.name, "rb")
+        st = os.fstat(f.fileno())
+        own = os.fstat(self.bibfile.fileno())
+        if (st.st_dev, st.st_ino) != (own.st_dev, own.st_ino):
+            f.close()
+            raise OSError("File was replaced: {}".format(self.bibfile.name))
+        return f
+
+    def _indexed_state(self):
+        """
+        Returns (size, mtime_ns, fingerprint) of the indexed prefix of the
+        bibfile, or None if it cannot be determined.
+        """
+        try:
+            with self._open_by_path() as f:
+                st = os.fstat(f.fileno())
+                size = self.scan_state[0]
+                return (size, st.st_mtime_ns, gen_fingerprint(f, size))
+        except (AttributeError, TypeError, OSError) as e:
+            logging.debug("(formats/bibtex:BibFmt) _indexed_state: {}".format(e))
+            return None
+
+    def _is_prefix(self, indexed):
+        """
+        Returns True if the file described by indexed (see _indexed_state) is
+        the bibfile unchanged, or a prefix of it (the rest was appended). The
+        file at the path of the bibfile must still be the open bibfile, which
+        is the one indexed and read.
+        """
+        size, mtime_ns, fingerprint = indexed
+
+        try:
+            with self._open_by_path() as f:
+                st = os.fstat(f.fileno())
+
+                # An unchanged file is not hashed again. A file with the same
+                # size but different mtime was edited in place; a grown file
+                # may also have been edited before entries were appended, so
+                # the whole indexed prefix is compared.
+                if st.st_size == size:
+                    return st.st_mtime_ns == mtime_ns
+                if st.st_size < size:
+                    return False
+
+                return gen_fingerprint(f, size) == fingerprint
+        except (AttributeError, TypeError, OSError) as e:
+            logging.debug("(formats/bibtex:BibFmt) _is_prefix: {}".format(e))
+            return False
+
+    def _load_index_cache(self):
+        """
+        Returns the cache if it is valid for the bibfile, or the prefix of the
+        bibfile it describes is unchanged (and the rest was appended);
+        otherwise returns None.
+        """
+        try:
+            path = os.path.abspath(self.bibfile.name)
+        except (AttributeError, TypeError):
+            return None
+
+        cache = load_pickle(index_cache_path(path))
+        if cache is None:
+            return None
+
+        if cache.get("version") != INDEX_CACHE_VERSION or cache["path"] != path:
+            return None
+
+        if not self._is_prefix(cache["indexed"]):
+            logging.debug("Index cache for '{}' is stale.".format(path))
+            return None
+
+        return cache
+
+    def _save_index_cache(self):
+        self.indexed = self._indexed_state()
+        if self.indexed is None:
+            return
+
+        path = os.path.abspath(self.bibfile.name)
+        cache = dict(version=INDEX_CACHE_VERSION,
+                     path=path,
+                     indexed=self.indexed,
+                     scan_state=self.scan_state,
+                     index=self.index)
+
+        try:
+            os.makedirs(os.path.expanduser(INDEX_CACHE_DIR), exist_ok=True)
+        except OSError:
+            pass
+
+        if not dump_pickle_atomic(index_cache_path(path), cache):
+            logging.debug("Could not write index cache for '{}'.".format(path))
+        else:
+            self.index_dirty = False
+
+    def _remove_index_cache(self):
+        try:
+            os.unlink(index_cache_path(self.bibfile.name))
+        except (AttributeError, TypeError, OSError):
+            pass
+
+    def _warn_duplicates(self):
+        if isinstance(self.index[CITEKEY], PostingsIndex):
+            for citekey, count in self.index[CITEKEY].duplicates():
+                for _ in range(count - 1):
+                    logging.warning("Duplicate cite-key found in {}: {}".format(
+                        self.bibfile.name, citekey))
+            return
+
+        for citekey, filepos_list in self.index[CITEKEY].items():
+            if type(filepos_list) is int: continue
+            for _ in filepos_list[1:]:
+                logging.warning("Duplicate cite-key found in {}: {}".format(
+                    self.bibfile.name, citekey))
 
     def build_index(self, *toindex):
-        # rewind
-        self.bibfile.seek(0, 0)
+        if self.use_index_db:
+            try:
+                self._build_index_db(frozenset(toindex))
+                if CITEKEY in self.index:
+                    self._warn_duplicates()
+                return
+            except (sqlite3.Error, OSError, ValueError) as e:
+                logging.warning("Could not use index database for '{}': {}".format(
+                    self.bibfile.name, e))
+                self.use_index_db = False
+                self.index_db = None
+                self.index = {}
 
-        for index in toindex:
-            if index not in self.index:
-                self.index[index] = {}
+        cache = self._load_index_cache() if self.index_cache else None
 
-        valid_entry = False
+        if cache is not None and all(index in cache["index"] for index in toindex):
+            self.index = cache["index"]
+            self.scan_state = cache["scan_state"]
+            self.indexed = cache["indexed"]
+            logging.debug("Using index cache for '{}' up to offset {}.".format(
+                cache["path"], self.scan_state[0]))
+        else:
+            # Rebuild all, so that all indices cover the same prefix of the
+            # file.
+            toindex = frozenset(toindex) | frozenset(self.index)
+            if cache is not None:
+                toindex |= frozenset(cache["index"])
 
-        # Manually incrementing position and using the line
-        # generator of the file object is MUCH faster than 
-        # calling readline() ! For purposes of building the index
-        # this is sufficient as I will not be seeking in the file.
-        line_begin_pos = 0
+            self.index = {index: {} for index in toindex}
+            self.scan_state = (0, False, 0)
 
-        for line in self.bibfile:
-            line_len = len(line.encode()) # of encoded line, so we can get offset
+        # If the cache is used, this only indexes appended entries.
+        start_pos = self.scan_state[0]
+        self._scan_index()
 
-            if line.startswith("@"):
-                valid_entry = True
-                last_entry_pos = line_begin_pos
+        if self.scan_state[0] != start_pos or self.indexed is None:
+            if self.index_cache:
+                self._save_index_cache()
+            else:
+                self.indexed = self._indexed_state()
 
-                if CITEKEY in toindex:
-                    braces = line.index("{")
-                    comma = line.index(",")
+        self.sorted_keys = {}
 
-                    citekey = line[braces+1:comma]
-                    if citekey not in self.index[CITEKEY]:
-                        self.index[CITEKEY][citekey] = [last_entry_pos]
-                    else:
-                        self.index[CITEKEY][citekey].append(last_entry_pos)
-                        logging.warning("Duplicate cite-key found in {}: {}".format(
-                            self.bibfile.name, citekey))
+        if CITEKEY in self.index:
+            self._warn_duplicates()
 
-            elif line in ENTRY_CLOSE:
-                valid_entry = False
+    def _build_index_db(self, toindex):
+        """
+        Opens the index database, and updates it for entries appended since
+        it was last updated; the database is rebuilt if the bibfile was
+        changed otherwise, or not all of toindex are indexed.
+        """
+        path = os.path.abspath(self.bibfile.name)
+        if self.index_db is None:
+            self.index_db = Database(index_db_path(path), INDEX_DB_VERSION,
+                                     wal=True)
 
-            # now strip it
-            line = line.strip()
-
-            if valid_entry:
-                if KEYWORDS in toindex:
-                    if line.startswith(KEYWORDS):
-                        # This will not work for multi-line keywords. Tradeoff
-                        # between proper parser and speed.
-                        keywords = line.split("=")[1].strip(" ,{}").split(",")
-                        for keyword in keywords:
-                            if keyword not in self.index[KEYWORDS]:
-                                self.index[KEYWORDS][keyword] = [last_entry_pos]
-                            else:
-                                self.index[KEYWORDS][keyword].append(last_entry_pos)
+        # Other processes wait until the database is updated.
+        fields = self.index_db.transaction(self._update_index_db, path, toindex)
+
+        self.index = {name: PostingsIndex(self.index_db, name, name in UNIQUE_INDICES)
+                      for name in fields}
+        self.sorted_keys = {}
+
+    def _update_index_db(self, db, path, toindex):
+        """
+        @return Indexed fields.
+        """
+        state = get_meta(db, "state")
+        if state is not None and state["path"] != path:
+            state = None
+
+        if state is not None and toindex <= frozenset(state["fields"]) and \
+                self._is_prefix(state["indexed"]):
+            fields = state["fields"]
+            self.scan_state = tuple(state["scan_state"])
+        else:
+            # Rebuild all, as in build_index.
+            fields = sorted(toindex | frozenset(state["fields"] if state else ()))
+            logging.info("Building index database for '{}'.".format(path))
+            db.execute("DELETE FROM postings")
+            self.scan_state = (0, False, 0)
+
+        size = os.fstat(self.bibfile.fileno()).st_size
+        if size > self.scan_state[0]:
+            with mmap.mmap(self.bibfile.fileno(), size, access=mmap.ACCESS_READ) as buf:
+                # Index in chunks of complete lines, and write each chunk to
+                # the database, to bound memory.
+                while True:
+                    pos = self.scan_state[0]
+                    end = buf.find(b"\n", min(size, pos + INDEX_CHUNK_SIZE) - 1) + 1
+                    if end <= pos:
+                        break
+
+                    index = {name: {} for name in fields}
+                    self.scan_state = index_buffer(buf, index, self.scan_state,
+                                                   end=end, encoding=self._encoding())
+                    add_postings(db, index_postings(index))
+
+        self.indexed = self._indexed_state()
+        set_meta(db, "state", dict(path=path, fields=fields,
+                                   scan_state=self.scan_state,
+                                   indexed=self.indexed))
+        return fields
+
+    def _update_index_db_entry(self, db, removed, added):
+        """
+        Replaces postings of an entry edited in place, and marks the edited
+        bibfile as indexed.
+        """
+        remove_postings(db, removed)
+        add_postings(db, added)
+
+        state = get_meta(db, "state")
+        if state is not None and tuple(state["scan_state"]) == self.scan_state:
+            self.indexed = state["indexed"] = self._indexed_state()
+            set_meta(db, "state", state)
+
+    def updated(self):
+        """
+        Returns a new BibFmt for the same bibfile, with the index updated for
+        entries appended since the index was built; returns None if the
+        bibfile was changed otherwise, and the index must be rebuilt. The
+        index of this BibFmt is not modified, so that it can continue to be
+        used concurrently.
+        """
+        if self.indexed is None or not self._is_prefix(self.indexed):
+            return None
 
-                if FILE in toindex:
-                    if line.startswith(FILE):
-                        filename = line.split("=")[1].strip(" ,{}")
-                        self.index[FILE][filename] = last_entry_pos
+        result = copy.copy(self)
+        # Appended entries may define strings.
+        result.macros = None
+        if self.index_db is not None:
+            # The index database is shared; indices are only added to.
+            result._build_index_db(frozenset(self.index))
+            return result
 
-                if HASH in toindex:
-                    if line.startswith(HASH):
-                        filename = line.split("=")[1].strip(" ,{}")
-                        self.index[HASH][filename] = last_entry_pos
+        result.sorted_keys = {}
+        result.index = {name: {} for name in self.index}
+        result._scan_index()
 
-            line_begin_pos += line_len
+        index = {name: dict(entries) for name, entries in self.index.items()}
+        merge_index(index, result.index)
+        result.index = index
+        result.indexed = result._indexed_state()
+
+        return result
+
+    def _scan_index(self):
+        """
+        Indexes all complete lines from the current scan position to the end
+        of the file.
+        """
+        size = os.fstat(self.bibfile.fileno()).st_size
+        if size <= self.scan_state[0]:
+            return
+
+        # Scan the bytes of the file directly, which avoids decoding and
+        # re-encoding every line to keep track of offsets.
+        with mmap.mmap(self.bibfile.fileno(), size, access=mmap.ACCESS_READ) as buf:
+            if self.index_jobs > 1 and \
+                    size - self.scan_state[0] >= PARALLEL_INDEX_MIN_SIZE:
+                self._scan_index_parallel(buf)
+            else:
+                self.scan_state = index_buffer(buf, self.index, self.scan_state,
+                                               encoding=self._encoding())
+
+    def _scan_index_parallel(self, buf):
+        """
+        Splits the remaining file at entry boundaries into index_jobs chunks,
+        and indexes them in a process pool.
+        """
+        pos = self.scan_state[0]
+        chunk_size = (len(buf) - pos) // self.index_jobs
+
+        boundaries = [pos]
+        for i in range(1, self.index_jobs):
+            boundary = buf.find(b"\n@", pos + i * chunk_size) + 1
+            if boundary <= boundaries[-1]:
+                break
+            boundaries.append(boundary)
+        boundaries.append(len(buf))
+
+        logging.debug("Building index for '{}' in {} chunks.".format(
+            self.bibfile.name, len(boundaries) - 1))
+
+        path = os.path.abspath(self.bibfile.name)
+        with ProcessPoolExecutor(max_workers=self.index_jobs) as executor:
+            futures = []
+            for start, end in zip(boundaries, boundaries[1:]):
+                # All but the first chunk begin with an entry.
+                scan_state = self.scan_state if start == pos else (start, False, 0)
+                futures.append(executor.submit(index_file_chunk, path,
+                                               list(self.index), scan_state,
+                                               end, self._encoding()))
+
+            # Merge in order of chunks, to preserve order of offsets.
+            for future in futures:
+                index, self.scan_state = future.result()
+                merge_index(self.index, index)
+
+    def _macros(self):
+        """
+        Returns the strings defined in the bibfile (see read_macros), which
+        are read on first use.
+        """
+        if self.macros is None:
+            size = os.fstat(self.bibfile.fileno()).st_size
+            if size == 0:
+                return {}
+            with mmap.mmap(self.bibfile.fileno(), size, access=mmap.ACCESS_READ) as buf:
+                self.macros = read_macros(buf, self._encoding())
+        return self.macros
+
+    def _encoding(self):
+        return getattr(self.bibfile, "encoding", None) or "utf-8"
+
+    def flush_index(self):
+        """
+        Writes back the index cache, if the index was updated after entries
+        were appended or updated.
+        """
+        if self.index_cache and self.index_dirty:
+            self.bibfile.flush()
+            self._save_index_cache()
 
     def query(self, index, key):
+        """
+        Returns offset of the entry with key in a unique index, or the sorted
+        sequence of offsets of entries with key in other indices; None if
+        there is no entry.
+        """
         try:
-            return self.index[index][key]
+            value = self.index[index][key]
         except:
             return None
 
-    def read_entry_raw(self, filepos):
-        self.bibfile.seek(filepos, 0)
-        result = []
+        if index in UNIQUE_INDICES:
+            return value
+        return as_postings(value)
 
-        while True:
-            line = self.bibfile.readline()
-            if len(line) == 0: break
+    def entry_offsets(self):
+        """
+        Returns sorted list of offsets of all entries; requires the cite-key
+        index.
+        """
+        if isinstance(self.index[CITEKEY], PostingsIndex):
+            return self.index[CITEKEY].entries()
 
-            result.append(line)
+        return sorted(filepos for filepos_list in self.index[CITEKEY].values()
+                      for filepos in as_postings(filepos_list))
 
-            if line in ENTRY_CLOSE:
+    def query_prefix(self, index, prefix):
+        """
+        Returns list of the results (as by query) of all keys of index
+        starting with prefix.
+        """
+        entries = self.index.get(index)
+        if entries is None:
+            return []
+
+        if isinstance(entries, PostingsIndex):
+            return [postings for _, postings in entries.prefix_items(prefix)]
+
+        keys = self.sorted_keys.get(index)
+        if keys is None:
+            keys = self.sorted_keys[index] = sorted(entries)
+
+        result = []
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
                 break
+            result.append(entries[keys[i]] if index in UNIQUE_INDICES
+                          else as_postings(entries[keys[i]]))
+        return result
 
-        return "".join(result)
+    def _read_entry_bytes(self, filepos):
+        """
+        Returns raw bytes of the entry at filepos.
+        """
+        return self._pread_entry(filepos).raw
 
-    def read_entry_dict(self, filepos):
-        self.bibfile.seek(filepos, 0)
-        entry_lines = []
+    def _pread_entry(self, filepos):
+        """
+        Returns Entry at filepos. Uses positional reads, which neither use nor
+        change the position of bibfile, so that entries may be read
+        concurrently.
+        """
+        fd = self.bibfile.fileno()
+        data = bytearray()
+        # Brace depth of data up to counted.
+        depth = counted = 0
 
+        # Read up to the next entry, or a closing line after which braces
+        # are balanced (see read_entry_at).
         while True:
-            line = self.bibfile.readline()
-            if len(line) == 0: break
+            block = os.pread(fd, READ_BLOCK_SIZE, filepos + len(data))
+            # Search from the beginning of the last line read.
+            search_pos = data.rfind(b"\n") + 1
+            data += block
 
-            entry_lines.append(line.strip())
+            if len(block) < READ_BLOCK_SIZE or \
+                    data.find(b"\n@", max(1, search_pos - 1)) >= 0:
+                break
 
-            if line in ENTRY_CLOSE: break
+            m = ENTRY_CLOSE_RE.search(data, search_pos)
+            if m is not None:
+                depth += data.count(b"{", counted, m.end()) - \
+                        data.count(b"}", counted, m.end())
+                counted = m.end()
+                if depth == 0:
+                    break
 
-        return convert_to_dict("".join(entry_lines))
+        return read_entry_at(data, 0, self._encoding(), self._macros)
+
+    def read_entry_lines(self, filepos):
+        """
+        Returns lines of the entry at filepos.
+        """
+        return self._read_entry_bytes(filepos).decode(self._encoding()).splitlines(True)
+
+    def read_entry(self, filepos):
+        """
+        @return Entry at filepos.
+        """
+        entry = self._pread_entry(filepos)
+        entry.filepos = filepos
+        return entry
+
+    def read_entries(self, offsets):
+        """
+        Returns generator of Entry for the entries at offsets, in order of
+        offsets. Entries are read in one pass over the file, which is faster
+        for many entries than read_entry for each.
+        """
+        offsets = sorted(offsets)
+        size = os.fstat(self.bibfile.fileno()).st_size
+        if len(offsets) == 0 or size == 0:
+            return
+
+        encoding = self._encoding()
+        with mmap.mmap(self.bibfile.fileno(), size, access=mmap.ACCESS_READ) as buf:
+            for filepos in offsets:
+                yield read_entry_at(buf, filepos, encoding, self._macros)
+
+    def read_all_entries(self):
+        """
+        Returns generator of Entry for all entries in the bibfile, including
+        @string and @preamble entries, in file order; comments are skipped.
+        """
+        size = os.fstat(self.bibfile.fileno()).st_size
+        if size == 0:
+            return
+
+        encoding = self._encoding()
+        with mmap.mmap(self.bibfile.fileno(), size, access=mmap.ACCESS_READ) as buf:
+            for parsed in parse_entries(buf, encoding=encoding):
+                yield make_entry(buf, parsed, ENTRY_TRAIL_RE.match(buf, parsed.end).end(),
+                                 encoding, self._macros)
+
+    def read_entry_raw(self, filepos):
+        return self._read_entry_bytes(filepos).decode(self._encoding())
+
+    def read_entry_dict(self, filepos):
+        return self.lines_to_dict(self.read_entry_lines(filepos))
+
+    def lines_to_dict(self, lines):
+        return convert_to_dict("".join(lines))
 
     def _process_extra(self, kwargs):
         # Add optional top information
@@ -199,7 +1449,7 @@ class BibFmt:
         extra_bottom_strings = []
 
         # pad file entry, so future file moves can be facilitated
-        file_padding = 128 - len(kwargs["file"])
+        file_padding = FILE_PADDING - len(kwargs["file"])
         if file_padding > 0:
             extra_bottom_strings.append("".ljust(file_padding))
 
@@ -215,10 +1465,36 @@ class BibFmt:
         print(self.template.safe_substitute(**self._process_extra(kwargs)))
 
     def append_new_entry(self, **kwargs):
+        self.append_entries([self.template.safe_substitute(**self._process_extra(kwargs))])
+
+    def append_entries(self, entries):
+        """
+        Appends entries, given as Entry or text, to the bibfile.
+
+        @return Number of entries appended.
+        """
         # seek to end
-        self.bibfile.seek(0, 2)
-        self.bibfile.write(self.template.safe_substitute(**self._process_extra(kwargs)))
-        self.bibfile.write("\n")
+        filepos = self.bibfile.seek(0, 2)
+        count = 0
+
+        for entry in entries:
+            text = entry.text() if isinstance(entry, Entry) else entry
+            if not text.endswith("\n"):
+                text += "\n"
+            self.bibfile.write(text + "\n")
+            count += 1
+
+        self.bibfile.flush()
+
+        # Update index with new entries, if the index covers the whole file.
+        if self.index_db is not None:
+            self._build_index_db(frozenset(self.index))
+        elif filepos == self.scan_state[0] and len(self.index) != 0:
+            self._scan_index()
+            self.index_dirty = True
+            self.sorted_keys = {}
+
+        return count
 
     def update_in_place(self, filepos, key, old_val, value):
         self.bibfile.seek(filepos, 0)
@@ -238,9 +1514,174 @@ class BibFmt:
                     if len(line) != len(new_line):
                         return False
 
+                    # The cache cannot detect edits within the file, so
+                    # remove it until the index is flushed.
+                    if self.index_cache:
+                        self._remove_index_cache()
+
                     self.bibfile.seek(start_line_pos, 0)
                     self.bibfile.write(new_line)
+                    self.bibfile.flush()
+
+                    if isinstance(self.index.get(FILE), PostingsIndex):
+                        self.index_db.transaction(self._update_index_db_entry,
+                                                  [(FILE, old_val, filepos)],
+                                                  [(FILE, value, filepos)])
+                    elif FILE in self.index and \
+                            self.index[FILE].get(old_val) == filepos:
+                        del self.index[FILE][old_val]
+                        self.index[FILE][value] = filepos
+                        self.sorted_keys.pop(FILE, None)
+                    self.index_dirty = True
                     break
 
         return True
 
+    def rewrite(self, edits):
+        """
+        Applies edits to entries in one pass over the bibfile: the file is
+        copied to a temporary file, with unchanged parts copied in large
+        blocks, which then atomically replaces the bibfile. The index is
+        updated to the new offsets.
+
+        @param edits Dict of entry offset to changes as for rewrite_entry, or
+                     to None to delete the entry.
+        @return True if the bibfile was rewritten.
+        """
+        path = os.path.abspath(self.bibfile.name)
+        tmppath = "{}.{}.tmp".format(path, os.getpid())
+        encoding = self._encoding()
+        self.bibfile.flush()
+
+        # (old offset, change of size) of edited entries, in file order.
+        changed = []
+
+        try:
+            size = os.fstat(self.bibfile.fileno()).st_size
+            with mmap.mmap(self.bibfile.fileno(), size, access=mmap.ACCESS_READ) as buf, \
+                    open(tmppath, "wb") as out:
+                pos = 0
+                for filepos in sorted(edits):
+                    if filepos < pos or buf[filepos:filepos + 1] != b"@":
+                        raise ParseError("No entry at offset {}".format(filepos))
+
+                    # Entries which cannot be parsed are not changed, as
+                    # their end is unknown.
+                    _, end = find_entry(buf, filepos, size, encoding)
+
+                    if edits[filepos] is None:
+                        text = b""
+                        # Also remove the empty line after the entry.
+                        if buf[end:end + 1] == b"\n":
+                            end += 1
+                    else:
+                        text = rewrite_entry(buf[filepos:end], edits[filepos], encoding)
+
+                    for block in range(pos, filepos, REWRITE_BLOCK_SIZE):
+                        out.write(buf[block:min(filepos, block + REWRITE_BLOCK_SIZE)])
+                    out.write(text)
+
+                    changed.append((filepos, len(text) - (end - filepos)))
+                    pos = end
+
+                for block in range(pos, size, REWRITE_BLOCK_SIZE):
+                    out.write(buf[block:min(size, block + REWRITE_BLOCK_SIZE)])
+
+                out.flush()
+                os.fsync(out.fileno())
+
+            mode = os.stat(path).st_mode
+            os.chmod(tmppath, mode)
+            os.replace(tmppath, path)
+        except (ParseError, OSError, ValueError) as e:
+            logging.error("Could not rewrite '{}': {}".format(path, e))
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            return False
+
+        # Make the rename durable.
+        try:
+            dirfd = os.open(os.path.dirname(path), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        except OSError:
+            pass
+
+        bibfile = self.bibfile
+        self.bibfile = open(path, bibfile.mode, encoding=getattr(bibfile, "encoding", None))
+        bibfile.close()
+        self.macros = None
+
+        self._remap_index(changed, {filepos for filepos, changes in edits.items()
+                                    if changes is not None})
+        return True
+
+    def _remap_index(self, changed, edited):
+        """
+        Updates the index after a rewrite.
+
+        @param changed (old offset, change of size) of rewritten entries.
+        @param edited Old offsets of entries which were changed but not
+                      deleted, which are indexed again.
+        """
+        starts = [filepos for filepos, _ in changed]
+        # shifts[i] is the change of offsets after the first i entries.
+        shifts = [0]
+        for _, delta in changed:
+            shifts.append(shifts[-1] + delta)
+
+        def remap(filepos):
+            return filepos + shifts[bisect.bisect_left(starts, filepos)]
+
+        if self.index_db is not None:
+            # Rebuild the index database, rather than update all offsets.
+            self.index_db.transaction(set_meta, "state", None)
+            self._build_index_db(frozenset(self.index))
+            return
+
+        removed = frozenset(starts)
+        for name, entries in self.index.items():
+            remapped = {}
+            for key, postings in entries.items():
+                postings = [remap(filepos) for filepos in as_postings(postings)
+                            if filepos not in removed]
+                if len(postings) == 1:
+                    remapped[key] = postings[0]
+                elif len(postings) != 0:
+                    remapped[key] = array(POSTING_TYPECODE, postings)
+            self.index[name] = remapped
+
+        pos, valid_entry, last_entry_pos = self.scan_state
+        self.scan_state = (remap(pos), valid_entry, remap(last_entry_pos))
+
+        # Index edited entries again.
+        size = os.fstat(self.bibfile.fileno()).st_size
+        if len(edited) != 0 and size != 0:
+            with mmap.mmap(self.bibfile.fileno(), size, access=mmap.ACCESS_READ) as buf:
+                for filepos in sorted(remap(filepos) for filepos in edited):
+                    if filepos >= self.scan_state[0]:
+                        continue
+
+                    index = {name: {} for name in self.index}
+                    _, end = find_entry(buf, filepos, size, self._encoding())
+                    index_buffer(buf, index, (filepos, False, 0), end=end,
+                                 encoding=self._encoding())
+
+                    for name, entries in index.items():
+                        for key, postings in entries.items():
+                            if name in UNIQUE_INDICES:
+                                self.index[name][key] = postings
+                            else:
+                                insert_posting(self.index[name], key, postings)
+
+        self.sorted_keys = {}
+        self.indexed = self._indexed_state()
+        # The cache cannot detect edits within the file, so remove it until
+        # the index is flushed.
+        if self.index_cache:
+            self._remove_index_cache()
+        self.index_dirty = True
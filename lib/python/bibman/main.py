@@ -24,7 +24,7 @@ import time
 import logging
 
 from bibman.bibfetch import frontend as bibfetch_frontend
-from bibman.commands import sync, query, webserve
+from bibman.commands import sync, query, webserve, convert
 
 class BibmanConfig:
     """
@@ -39,10 +39,43 @@ class BibmanConfig:
                            help="Loglevel (DEBUG, INFO, WARNING, ERROR, CRITICAL). [Default:INFO]")
         parser.add_argument("--format", metavar="FORMAT", type=str,
                             dest="format", default="bibtex",
-                            help="Bibliography format. [Default:bibtex]")
+                            help="Bibliography format: bibtex, or bibstore (see convert). [Default:bibtex]")
         parser.add_argument("--fetch-prio", metavar="PRIOLIST", type=str,
                             dest="fetch_prio_list", default=[], nargs="+",
                             help="Priority list of fetching engines to use.")
+        parser.add_argument("--fetch-jobs", metavar="N", type=int,
+                            dest="fetch_jobs", default=4,
+                            help="Maximum number of concurrent remote fetches. [Default:4]")
+        parser.add_argument("--fetch-rate", metavar="SECONDS", type=float,
+                            dest="fetch_rate", default=0,
+                            help="Minimum interval between calls to the same fetching engine. [Default:0]")
+        parser.add_argument("--fetch-timeout", metavar="SECONDS", type=float,
+                            dest="fetch_timeout", default=60,
+                            help="Timeout for text extraction and each fetching engine; 0 to disable. [Default:60]")
+        parser.add_argument("--fetch-pages", metavar="N", type=int,
+                            dest="fetch_pages", default=0,
+                            help="Only extract text from the first N pages of files for remote fetching; 0 for no limit. [Default:0]")
+        parser.add_argument("--no-fetch-cache", action="store_false",
+                            dest="fetch_cache", default=True,
+                            help="Do not use or update the cache of remote fetching results.")
+        parser.add_argument("--clear-fetch-cache", action="store_true",
+                            dest="clear_fetch_cache", default=False,
+                            help="Clear the cache of remote fetching results.")
+        parser.add_argument("--fetch-cache-size", metavar="N", type=int,
+                            dest="fetch_cache_size", default=10000,
+                            help="Maximum number of cached remote fetching results. [Default:10000]")
+        parser.add_argument("--fetch-negative-ttl", metavar="SECONDS", type=float,
+                            dest="fetch_negative_ttl", default=7*24*3600,
+                            help="Time after which failed remote fetches are retried. [Default:1 week]")
+        parser.add_argument("--no-index-cache", action="store_false",
+                            dest="index_cache", default=True,
+                            help="Do not use or update the on-disk index cache.")
+        parser.add_argument("--index-db", action="store_true",
+                            dest="index_db", default=False,
+                            help="Query indices in an SQLite database next to the bibliography file, updated incrementally, instead of loading them into memory.")
+        parser.add_argument("--index-jobs", metavar="N", type=int,
+                            dest="index_jobs", default=1,
+                            help="Number of processes to build the index of large files with; 0 for one per CPU. [Default:1]")
         parser.add_argument("-b", "--bibfile", metavar="BIBFILE", type=str,
                             dest="bibfile", required=True,
                             help="Bibliograpy file to work with.")
@@ -65,6 +98,10 @@ class BibmanConfig:
                 help="Webserver for bibliography file.")
         webserve.register_args(parser_webserve)
 
+        parser_convert = subparsers.add_parser("convert", aliases=["c"],
+                help="Convert bibliography file to another format.")
+        convert.register_args(parser_convert)
+
         # Parse args and setup logging
         self.args = parser.parse_args()
         self._setup_logging()
@@ -73,6 +110,11 @@ class BibmanConfig:
         self.bibfmt_module = __import__("bibman.formats.{}".format(self.args.format),
                                         fromlist=["*"])
 
+        # Arguments passed to all BibFmt instances
+        self.bibfmt_args = dict(index_cache=self.args.index_cache,
+                                index_jobs=self.args.index_jobs,
+                                index_db=self.args.index_db)
+
         # Setup the remote fetching engine
         self.bibfetch = bibfetch_frontend.Frontend(self.args)
 
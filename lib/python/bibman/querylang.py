@@ -0,0 +1,349 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Boolean query language over the indices of a BibFmt.
+
+Syntax:
+    expr   := and (("OR" | "|" | "~") and)*
+    and    := unary (["AND" | "&" | ","] unary)*
+    unary  := ("NOT" | "!") unary | "(" expr ")" | term
+    term   := [field ":"] value
+
+A value is a word or a double-quoted string, looked up in the index of the
+field (or the default index; also if the field is not a known index).
+Adjacent words are one value (e.g. a keyword of several words, as in
+'machine learning'), except in full-text indices, whose values are split into
+words (see util.tokenize), all of which must match; separate terms with ','
+or AND. Within a word, '&', '|' and '!' are part of the value (e.g. 'R&D'),
+and only operators at the beginning of a word. A value ending in '*' matches
+all keys with that prefix, and for the year index, 'FROM..TO' matches a range
+of years (either bound may be omitted).
+
+Queries are compiled into a plan, which evaluates the terms of an AND in order
+of the size of their posting lists, and stops as soon as the intersection is
+empty. Results are sorted lists of entry offsets.
+"""
+
+import bisect
+import functools
+import itertools
+import re
+
+from bibman.util import tokenize
+
+TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<op>[()|~&,!])
+      | (?:(?P<field>[A-Za-z][\w-]*):)?(?:"(?P<quoted>[^"]*)"|(?P<word>[^\s()|~&,!"][^\s()~,"]*))
+    )""", re.VERBOSE)
+
+OPERATORS = {"AND": "&", "OR": "|", "NOT": "!", ",": "&", "~": "|"}
+
+YEAR = "year"
+
+class QueryError(ValueError):
+    pass
+
+def intersect(a, b):
+    """
+    Returns sorted list of offsets in both sorted lists a and b.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+
+    if len(a) * 8 < len(b):
+        # Much smaller: search for each element of a in b.
+        result = []
+        lo = 0
+        for x in a:
+            lo = bisect.bisect_left(b, x, lo)
+            if lo == len(b):
+                break
+            if b[lo] == x:
+                result.append(x)
+        return result
+
+    bset = set(b)
+    return [x for x in a if x in bset]
+
+def union(lists):
+    """
+    Returns sorted list of offsets in any of the sorted lists.
+    """
+    if len(lists) == 0:
+        return []
+    if len(lists) == 1:
+        return list(lists[0])
+
+    # Faster than merging the sorted lists in Python.
+    return sorted(set(itertools.chain.from_iterable(lists)))
+
+def difference(a, b):
+    """
+    Returns sorted list of offsets in sorted list a but not in b.
+    """
+    bset = set(b)
+    return [x for x in a if x not in bset]
+
+class Term:
+    def __init__(self, index, value, prefix=False):
+        self.index = index
+        self.value = value
+        self.prefix = prefix
+
+    def postings(self, bibfmt):
+        """
+        Returns list of sorted posting lists matching the term.
+        """
+        if self.prefix:
+            results = bibfmt.query_prefix(self.index, self.value)
+        else:
+            results = [bibfmt.query(self.index, self.value) or []]
+
+        # Indices of unique keys (e.g. file) map to a single offset.
+        return [[r] if isinstance(r, int) else r for r in results]
+
+    def estimate(self, bibfmt):
+        return sum(len(p) for p in self.postings(bibfmt))
+
+    def evaluate(self, bibfmt):
+        return union(self.postings(bibfmt))
+
+class YearRange(Term):
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+
+    def postings(self, bibfmt):
+        return [bibfmt.query(self.index, year) for year in
+                (bibfmt.index.get(self.index) or {})
+                if year.isdigit() and
+                   (self.start is None or int(year) >= self.start) and
+                   (self.end is None or int(year) <= self.end)]
+
+class All:
+    """
+    All entries; used for queries consisting of negated terms only.
+    """
+    def estimate(self, bibfmt):
+        return len(bibfmt.index.get("citekey") or ())
+
+    def evaluate(self, bibfmt):
+        return bibfmt.entry_offsets() if "citekey" in bibfmt.index else []
+
+class And:
+    def __init__(self, terms, negated):
+        self.terms = terms
+        self.negated = negated
+
+    def estimate(self, bibfmt):
+        return min(term.estimate(bibfmt) for term in self.terms)
+
+    def evaluate(self, bibfmt):
+        # Intersect the smallest first, to keep intermediate results small.
+        terms = sorted(self.terms, key=lambda term: term.estimate(bibfmt))
+
+        result = terms[0].evaluate(bibfmt)
+        for term in terms[1:]:
+            if len(result) == 0:
+                return result
+            result = intersect(result, term.evaluate(bibfmt))
+
+        for term in self.negated:
+            if len(result) == 0:
+                return result
+            result = difference(result, term.evaluate(bibfmt))
+
+        return result
+
+class Or:
+    def __init__(self, terms):
+        self.terms = terms
+
+    def estimate(self, bibfmt):
+        return sum(term.estimate(bibfmt) for term in self.terms)
+
+    def evaluate(self, bibfmt):
+        return union([term.evaluate(bibfmt) for term in self.terms])
+
+class Parser:
+    def __init__(self, text, default_index, fields, text_indices):
+        self.tokens = self._lex(text)
+        self.pos = 0
+        self.default_index = default_index
+        self.fields = frozenset(fields)
+        self.text_indices = frozenset(text_indices)
+
+    def _lex(self, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            m = TOKEN_RE.match(text, pos)
+            if m is None:
+                raise QueryError("Invalid query at: {}".format(text[pos:]))
+            pos = m.end()
+
+            if m.group("op"):
+                tokens.append(("op", OPERATORS.get(m.group("op"), m.group("op"))))
+            elif m.group("word") in OPERATORS and not m.group("field"):
+                tokens.append(("op", OPERATORS[m.group("word")]))
+            else:
+                # (field, value, word), where word is False for quoted values.
+                value = m.group("word")
+                if value is None:
+                    tokens.append(("term", (m.group("field"), m.group("quoted"), False)))
+                else:
+                    tokens.append(("term", (m.group("field"), value, True)))
+        return tokens
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            raise QueryError("Empty query")
+
+        node = self._parse_or()
+        if self.pos != len(self.tokens):
+            raise QueryError("Unexpected: {}".format(self._peek()[1]))
+        return node
+
+    def _parse_or(self):
+        terms = [self._parse_and()]
+        while self._peek() == ("op", "|"):
+            self._next()
+            terms.append(self._parse_and())
+        return terms[0] if len(terms) == 1 else Or(terms)
+
+    def _parse_and(self):
+        terms = []
+        negated = []
+        while True:
+            kind, value = self._peek()
+            if kind is None or value in ("|", ")"):
+                break
+            if value == "&":
+                self._next()
+                continue
+
+            is_negated, node = self._parse_unary()
+            (negated if is_negated else terms).append(node)
+
+        if len(terms) == 0 and len(negated) == 0:
+            raise QueryError("Missing term")
+        if len(terms) == 0:
+            terms = [All()]
+        if len(terms) == 1 and len(negated) == 0:
+            return terms[0]
+        return And(terms, negated)
+
+    def _parse_unary(self):
+        """
+        @return (negated, node)
+        """
+        kind, value = self._next()
+        if kind is None:
+            raise QueryError("Unexpected end of query")
+
+        if value == "!":
+            negated, node = self._parse_unary()
+            return not negated, node
+
+        if kind == "op":
+            if value != "(":
+                raise QueryError("Unexpected: {}".format(value))
+            node = self._parse_or()
+            if self._next() != ("op", ")"):
+                raise QueryError("Missing ')'")
+            return False, node
+
+        field, value, word = value
+        if field is not None and field not in self.fields:
+            # Not a field, but part of the value (e.g. cite-key 'knuth:84').
+            value = "{}:{}".format(field, value)
+            field = None
+
+        index = field or self.default_index
+        if word and index not in self.text_indices:
+            # Adjacent words without field are one value.
+            while True:
+                kind, token = self._peek()
+                if kind != "term" or token[0] is not None or not token[2]:
+                    break
+                self._next()
+                value = "{} {}".format(value, token[1])
+
+        return False, self._compile_term(index, value)
+
+    def _compile_term(self, index, value):
+        prefix = value.endswith("*")
+        if prefix:
+            value = value[:-1]
+
+        if index == YEAR and ".." in value:
+            start, end = value.split("..", 1)
+            try:
+                return YearRange(index, int(start) if start else None,
+                                 int(end) if end else None)
+            except ValueError:
+                raise QueryError("Invalid year range: {}".format(value))
+
+        if index in self.text_indices:
+            words = tokenize(value)
+            if len(words) == 0:
+                raise QueryError("No words in: {}".format(value))
+
+            terms = [Term(index, word) for word in words]
+            terms[-1].prefix = prefix
+            return terms[0] if len(terms) == 1 else And(terms, [])
+
+        if len(value) == 0 and not prefix:
+            raise QueryError("Empty value for: {}".format(index))
+
+        return Term(index, value, prefix)
+
+@functools.lru_cache(maxsize=256)
+def compile_query(text, default_index, fields, text_indices=()):
+    """
+    Compiles query text into a plan.
+
+    @param default_index Index for values without field.
+    @param fields Indices which may be given as field.
+    @param text_indices Full-text indices, whose values are split into words.
+    @return Plan, whose evaluate(bibfmt) returns the sorted list of offsets
+            of matching entries.
+    """
+    return Parser(text, default_index, fields, text_indices).parse()
+
+def query_indices(plan):
+    """
+    @return Set of indices the plan uses.
+    """
+    if isinstance(plan, Term):
+        return {plan.index}
+    if isinstance(plan, All):
+        return {"citekey"}
+
+    result = set()
+    for term in getattr(plan, "terms", []) + getattr(plan, "negated", []):
+        result |= query_indices(term)
+    return result
@@ -0,0 +1,223 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Indices in an SQLite database: a postings table of (field, key, entry), where
+entry is the offset (or id) of an entry, and a table of metadata. Used by the
+bibstore format, and by the bibtex format for on-disk indices.
+"""
+
+import collections.abc
+import itertools
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS postings (
+    field TEXT NOT NULL,
+    key TEXT NOT NULL,
+    entry INTEGER NOT NULL,
+    PRIMARY KEY (field, key, entry)
+) WITHOUT ROWID;
+"""
+
+# Upper bound of all strings with a given prefix, for range queries.
+PREFIX_END = "\U0010ffff"
+
+# Time to wait for the lock of a database written by another process; builds
+# of the index of large files hold it for a while.
+LOCK_TIMEOUT = 600
+
+class Database:
+    """
+    Connection to a database with the postings and meta tables, which is
+    shared by threads, and reopened in forked processes (e.g. server
+    workers).
+    """
+    def __init__(self, path, version, schema=SCHEMA, readonly=False, wal=False):
+        self.path = os.path.abspath(path)
+        self.version = version
+        self.schema = schema
+        self.readonly = readonly
+        self.wal = wal
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_pid = None
+
+        self.execute("SELECT 1")
+
+    def _connect(self):
+        if self.readonly:
+            db = sqlite3.connect("file:{}?mode=ro".format(self.path), uri=True,
+                                 timeout=LOCK_TIMEOUT, check_same_thread=False)
+        else:
+            db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT,
+                                 check_same_thread=False)
+            if self.wal:
+                # Readers do not block the writer, and vice versa.
+                db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(self.schema)
+            with db:
+                db.execute("INSERT OR IGNORE INTO meta VALUES ('version', ?)",
+                           (self.version,))
+
+        row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != self.version:
+            db.close()
+            raise ValueError("Not a database of version {}: {}".format(
+                self.version, self.path))
+
+        return db
+
+    def _connection(self):
+        if self.db is None or self.db_pid != os.getpid():
+            self.db = self._connect()
+            self.db_pid = os.getpid()
+        return self.db
+
+    def execute(self, sql, params=()):
+        """
+        Executes sql, and returns all rows of the result.
+        """
+        with self.lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    def transaction(self, func, *args):
+        """
+        Calls func(db, *args) in a transaction, which holds the write lock of
+        the database from the start, and returns its result.
+        """
+        with self.lock:
+            db = self._connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(db, *args)
+            except:
+                db.rollback()
+                raise
+            db.commit()
+            return result
+
+def get_meta(db, key, default=None):
+    """
+    Returns value of key in the meta table, decoded from JSON.
+    """
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row is not None else default
+
+def set_meta(db, key, value):
+    db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+def add_postings(db, postings):
+    """
+    Adds postings, given as (field, key, entry).
+    """
+    db.executemany("INSERT OR IGNORE INTO postings VALUES (?, ?, ?)", postings)
+
+def remove_postings(db, postings):
+    db.executemany("DELETE FROM postings WHERE field = ? AND key = ? AND entry = ?",
+                   postings)
+
+def index_postings(index):
+    """
+    Returns generator of (field, key, entry) of an index as built by the
+    bibtex format: dicts of keys to an offset or posting list.
+    """
+    for field, entries in index.items():
+        for key, postings in entries.items():
+            if type(postings) is int:
+                yield field, key, postings
+            else:
+                for filepos in postings:
+                    yield field, key, filepos
+
+class PostingsIndex(collections.abc.Mapping):
+    """
+    Read-only mapping of the keys of an index to the offset of the entry (for
+    unique indices), or the sorted list of offsets of the entries with the
+    key; queries the database on each access.
+    """
+    def __init__(self, database, field, unique=False):
+        self.database = database
+        self.field = field
+        self.unique = unique
+
+    def _postings(self, entries):
+        # For unique indices, the last entry wins, as with dicts.
+        return entries[-1] if self.unique else entries
+
+    def __getitem__(self, key):
+        rows = self.database.execute(
+                "SELECT entry FROM postings WHERE field = ? AND key = ? ORDER BY entry",
+                (self.field, key))
+        if len(rows) == 0:
+            raise KeyError(key)
+        return self._postings([row[0] for row in rows])
+
+    def __contains__(self, key):
+        return len(self.database.execute(
+                "SELECT 1 FROM postings WHERE field = ? AND key = ? LIMIT 1",
+                (self.field, key))) != 0
+
+    def __iter__(self):
+        return (row[0] for row in self.database.execute(
+                "SELECT DISTINCT key FROM postings WHERE field = ? ORDER BY key",
+                (self.field,)))
+
+    def __len__(self):
+        return self.database.execute(
+                "SELECT COUNT(DISTINCT key) FROM postings WHERE field = ?",
+                (self.field,))[0][0]
+
+    def items(self):
+        # One query, rather than one per key.
+        return self.prefix_items("")
+
+    def values(self):
+        return [postings for _, postings in self.items()]
+
+    def prefix_items(self, prefix):
+        """
+        @return List of (key, postings) of all keys with prefix, sorted by key.
+        """
+        rows = self.database.execute(
+                "SELECT key, entry FROM postings WHERE field = ? AND key >= ? "
+                "AND key < ? ORDER BY key, entry",
+                (self.field, prefix, prefix + PREFIX_END))
+
+        return [(key, self._postings([row[1] for row in group]))
+                for key, group in itertools.groupby(rows, key=lambda row: row[0])]
+
+    def entries(self):
+        """
+        @return Sorted list of offsets of all entries with any key.
+        """
+        return [row[0] for row in self.database.execute(
+                "SELECT DISTINCT entry FROM postings WHERE field = ? ORDER BY entry",
+                (self.field,))]
+
+    def duplicates(self):
+        """
+        @return List of (key, number of entries) of keys with more than one
+                entry.
+        """
+        return self.database.execute(
+                "SELECT key, COUNT(*) FROM postings WHERE field = ? "
+                "GROUP BY key HAVING COUNT(*) > 1", (self.field,))
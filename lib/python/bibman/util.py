@@ -16,24 +16,290 @@
 Utility functions
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import fnmatch
 import hashlib
 import string
+import os
+import pickle
+import logging
+import queue
+import re
+import threading
 
 FILENAME_VALID_CHARS = frozenset("-_(). {}{}".format(string.ascii_letters, string.digits))
 
+HASH_BLOCK_SIZE = 1 << 20
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", "~/.cache"), "bibman")
+
+IGNORE_FILENAME = ".bibmanignore"
+
 def gen_hash_md5(path):
     md5 = hashlib.md5()
+    buf = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(buf)
 
-    with open(path, "rb") as f:
-        f.seek(0, 2)
-        fsize = f.tell()
-        f.seek(0, 0)
-
-        while f.tell() != fsize:
-            md5.update(f.read(128))
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n: break
+            md5.update(view[:n])
 
     return md5
 
+def ordered_map(func, iterable, jobs):
+    """
+    Like map(func, iterable), but runs func in a pool of jobs threads. Results
+    are yielded in order, and at most 2*jobs items are taken from iterable
+    ahead of the result being yielded.
+    """
+    if jobs <= 1:
+        yield from map(func, iterable)
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+class HashCache:
+    """
+    Persistent cache of MD5 digests of files; a digest is valid as long as
+    size, mtime and inode of the file are unchanged.
+    """
+    def __init__(self, path=os.path.join(CACHE_DIR, "md5-cache")):
+        self.path = os.path.expanduser(path)
+        self.cache = load_pickle(self.path) or {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        # Statistics
+        self.skipped = 0
+        self.hashed = 0
+
+    def hexdigest(self, path, force=False):
+        """
+        Returns MD5 hexdigest of file at path; only hashes the file if its
+        size, mtime or inode changed since it was last hashed, or if force is
+        set.
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        st = os.stat(path)
+        signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+        cached = self.cache.get(path)
+        if not force and cached is not None and cached[0] == signature:
+            with self.lock:
+                self.skipped += 1
+            return cached[1]
+
+        digest = gen_hash_md5(path).hexdigest()
+
+        with self.lock:
+            self.cache[path] = (signature, digest)
+            self.dirty = True
+            self.hashed += 1
+
+        return digest
+
+    def save(self):
+        if not self.dirty: return
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        except OSError:
+            pass
+
+        if dump_pickle_atomic(self.path, self.cache):
+            self.dirty = False
+        else:
+            logging.warning("Could not write hash cache: {}".format(self.path))
+
+def load_pickle(path):
+    """
+    Loads a pickled object from path; returns None if the file does not exist
+    or cannot be unpickled.
+    """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.debug("(util:load_pickle) {}: {}".format(path, e))
+        return None
+
+def dump_pickle_atomic(path, obj):
+    """
+    Pickles obj to path, writing to a temporary file first and renaming it,
+    so that concurrent readers never see a partially written file.
+    """
+    tmppath = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmppath, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, path)
+        return True
+    except Exception as e:
+        logging.debug("(util:dump_pickle_atomic) {}: {}".format(path, e))
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        return False
+
+def compile_globs(patterns):
+    """
+    Returns function matching a string against any of the glob patterns, or
+    None if there are no patterns.
+    """
+    if not patterns: return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns)).match
+
+def read_ignore_file(path):
+    try:
+        with open(path, "r") as f:
+            return [line.strip() for line in f
+                    if len(line.strip()) != 0 and not line.startswith("#")]
+    except OSError as e:
+        logging.warning("Could not read '{}': {}".format(path, e))
+        return []
+
+class FileWalker:
+    """
+    Walks directory trees using os.scandir, generating paths of files with
+    one of the given extensions. Files and directories are skipped if they
+    match an exclude pattern, or a pattern in a .bibmanignore file in the same
+    or a parent directory; files are only considered if they match an include
+    pattern, if any.
+
+    Patterns are matched against the name as well as the path relative to the
+    root (or the directory of the .bibmanignore file).
+    """
+    def __init__(self, extlist, include=None, exclude=None):
+        self.extensions = frozenset(ext.lower().lstrip(".") for ext in extlist)
+        self.include = compile_globs(include)
+        self.exclude = compile_globs(exclude)
+        self.home = os.path.expanduser("~")
+
+    def _ignored(self, ignores, dirpath, name):
+        for ignore_dir, match in ignores:
+            if match(name) or match(os.path.relpath(os.path.join(dirpath, name),
+                                                    ignore_dir)):
+                return True
+        return False
+
+    def walk(self, root):
+        root = os.path.abspath(root)
+        stack = [(root, [])]
+
+        while stack:
+            dirpath, ignores = stack.pop()
+
+            ignore_path = os.path.join(dirpath, IGNORE_FILENAME)
+            if os.path.isfile(ignore_path):
+                match = compile_globs(read_ignore_file(ignore_path))
+                if match is not None:
+                    ignores = ignores + [(dirpath, match)]
+
+            try:
+                entries = list(os.scandir(dirpath))
+            except OSError as e:
+                logging.warning("Could not read directory: {}".format(e))
+                continue
+
+            subdirs = []
+            for entry in entries:
+                relpath = os.path.relpath(entry.path, root)
+
+                if self.exclude is not None and \
+                        (self.exclude(entry.name) or self.exclude(relpath)):
+                    continue
+
+                if ignores and self._ignored(ignores, dirpath, entry.name):
+                    continue
+
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.path, ignores))
+                        continue
+
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+
+                if entry.name.rsplit(".", 1)[-1].lower() not in self.extensions:
+                    continue
+
+                if self.include is not None and \
+                        not (self.include(entry.name) or self.include(relpath)):
+                    continue
+
+                path = entry.path
+                if path.startswith(self.home + os.sep):
+                    path = "~" + path[len(self.home):]
+
+                yield path
+
+            # Visit in order of names, as listed.
+            stack.extend(reversed(subdirs))
+
+    def walk_all(self, roots, jobs=4):
+        """
+        Generates paths of files in all roots; with multiple roots, these are
+        walked concurrently by up to jobs threads, and paths are generated as
+        they are found.
+        """
+        roots = list(roots)
+        if jobs <= 1 or len(roots) <= 1:
+            for root in roots:
+                yield from self.walk(root)
+            return
+
+        paths = queue.Queue(maxsize=1024)
+        stop = threading.Event()
+        done = object()
+
+        def walk_root(root):
+            try:
+                for path in self.walk(root):
+                    while not stop.is_set():
+                        try:
+                            paths.put(path, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set(): break
+            finally:
+                paths.put(done)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for root in roots:
+                executor.submit(walk_root, root)
+
+            try:
+                remaining = len(roots)
+                while remaining != 0:
+                    path = paths.get()
+                    if path is done:
+                        remaining -= 1
+                    else:
+                        yield path
+            finally:
+                stop.set()
+                # Unblock walkers waiting on a full queue.
+                while remaining != 0:
+                    if paths.get() is done:
+                        remaining -= 1
+
 def gen_filename_from_bib(bibdict):
     # If the title has a : in it, I assume it's in the TITLE:MOREDESCRIPTIVETITLE format.
     # We can exploit this to get a shorter filename.
@@ -49,3 +315,17 @@ def gen_filename_from_bib(bibdict):
 
     return ''.join(c for c in filename if c in FILENAME_VALID_CHARS)
 
+
+TOKEN_RE = re.compile(r"\w+")
+
+# TeX commands (e.g. accents) and braces, which are removed before splitting
+# text into words, so that e.g. 'A {B}ayesian' and 'Schr\"{o}dinger' are
+# not split.
+TEX_MARKUP_RE = re.compile(r"\\(?:[A-Za-z]+|.)|[{}]")
+
+def tokenize(text):
+    """
+    Returns list of lower-case words in text, as used for full-text indices
+    and queries.
+    """
+    return TOKEN_RE.findall(TEX_MARKUP_RE.sub("", text).lower())
@@ -0,0 +1,66 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Tests; run with 'python -m pytest' or 'python -m unittest' from the top-level
+directory.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "lib", "python"))
+
+from bibman.formats import bibtex
+
+class TempDirTestCase(unittest.TestCase):
+    """
+    Test case with a temporary directory, which also holds the index cache.
+    """
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+        patcher = unittest.mock.patch.object(bibtex, "INDEX_CACHE_DIR",
+                                             os.path.join(self.tmpdir, "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def write(self, name, text):
+        with open(self.path(name), "w") as f:
+            f.write(text)
+        return self.path(name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def open_bibfmt(self, name, *toindex, mode="r", module=bibtex, **kwargs):
+        """
+        Returns BibFmt of file name, with the given indices built; the file is
+        closed on cleanup.
+        """
+        bibfmt = module.BibFmt(open(self.path(name), mode), **kwargs)
+        self.addCleanup(lambda: bibfmt.bibfile.close())
+        bibfmt.build_index(*toindex)
+        return bibfmt
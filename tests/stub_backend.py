@@ -0,0 +1,44 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Stub bibfetch backend for tests; load with --fetch-prio tests.stub_backend.
+
+Results and delays are looked up by the file name passed to remote_fetch.
+"""
+
+import threading
+import time
+
+# File name to result returned for it; other files give None.
+RESULTS = {}
+# File name to seconds to wait before returning.
+DELAYS = {}
+# (file name, time.monotonic()) of all calls, in order of calls.
+CALLS = []
+
+lock = threading.Lock()
+
+def reset():
+    RESULTS.clear()
+    DELAYS.clear()
+    with lock:
+        del CALLS[:]
+
+def remote_fetch(filename=None, **kwargs):
+    with lock:
+        CALLS.append((filename, time.monotonic()))
+    time.sleep(DELAYS.get(filename, 0))
+    return RESULTS.get(filename)
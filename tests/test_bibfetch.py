@@ -0,0 +1,154 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import os
+import signal
+import subprocess
+import time
+import unittest
+import unittest.mock
+
+from tests import stub_backend, TempDirTestCase
+from bibman.bibfetch.frontend import Frontend, FetchCache, TEXTSEARCH_WORDS
+
+def frontend(**kwargs):
+    args = dict(fetch_prio_list=["tests.stub_backend"], fetch_rate=0,
+                fetch_jobs=4, fetch_timeout=0, fetch_pages=1,
+                clear_fetch_cache=False, fetch_cache=False,
+                fetch_cache_size=100, fetch_negative_ttl=3600)
+    args.update(kwargs)
+    return Frontend(argparse.Namespace(**args))
+
+class FrontendTest(unittest.TestCase):
+    def setUp(self):
+        stub_backend.reset()
+        self.addCleanup(stub_backend.reset)
+
+    def test_fetch_many_ordered(self):
+        names = ["f{}.txt".format(i) for i in range(8)]
+        for i, name in enumerate(names):
+            stub_backend.RESULTS[name] = {"title": name}
+            # Later items finish first.
+            stub_backend.DELAYS[name] = 0.01 * (len(names) - i)
+
+        start = time.monotonic()
+        results = list(frontend().fetch_many(names, lambda name: {"filename": name}))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(results, [(name, {"title": name}) for name in names])
+        # Fetched concurrently: less than the sum of the delays.
+        self.assertLess(elapsed, sum(stub_backend.DELAYS.values()))
+
+    def test_timeout(self):
+        stub_backend.DELAYS["slow.txt"] = 1
+        stub_backend.RESULTS["slow.txt"] = {"title": "slow"}
+        stub_backend.RESULTS["fast.txt"] = {"title": "fast"}
+
+        fe = frontend(fetch_timeout=0.05)
+        start = time.monotonic()
+        self.assertIsNone(fe(filename="slow.txt"))
+        self.assertLess(time.monotonic() - start, 0.5)
+
+        self.assertEqual(fe(filename="fast.txt"), {"title": "fast"})
+
+    def test_timeout_falls_back_to_next_backend(self):
+        stub_backend.DELAYS["slow.txt"] = 1
+        fe = frontend(fetch_timeout=0.05)
+
+        # The second backend is called after the first timed out.
+        fe.backends.append(("other", lambda **kwargs: {"title": "other"},
+                            fe.backends[0][2]))
+        self.assertEqual(fe(filename="slow.txt"), {"title": "other"})
+
+    def test_rate_limit(self):
+        interval = 0.05
+        names = ["f{}.txt".format(i) for i in range(4)]
+        list(frontend(fetch_rate=interval).fetch_many(
+            names, lambda name: {"filename": name}))
+
+        times = sorted(t for _, t in stub_backend.CALLS)
+        self.assertEqual(len(times), len(names))
+        for a, b in zip(times, times[1:]):
+            # Allow for timer granularity.
+            self.assertGreaterEqual(b - a, interval * 0.9)
+
+class ExtractWordsTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        # Stub pdftotext, which records its arguments and outputs words until
+        # it is terminated.
+        os.mkdir(self.path("bin"))
+        stub = self.write(os.path.join("bin", "pdftotext"),
+                          '#!/bin/sh\necho "$@" > {}\nexec yes word\n'.format(
+                              self.path("args")))
+        os.chmod(stub, 0o755)
+
+        path = self.path("bin") + os.pathsep + os.environ.get("PATH", "")
+        patcher = unittest.mock.patch.dict(os.environ, PATH=path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_word_limit(self):
+        procs = []
+        Popen = subprocess.Popen
+        def popen(*args, **kwargs):
+            procs.append(Popen(*args, **kwargs))
+            return procs[-1]
+
+        with unittest.mock.patch("subprocess.Popen", side_effect=popen):
+            words = frontend(fetch_pages=2).extract_words("paper.pdf")
+
+        self.assertEqual(words, ["word"] * TEXTSEARCH_WORDS)
+        # Reading stopped at the word limit, and pdftotext was terminated.
+        self.assertEqual(procs[0].returncode, -signal.SIGTERM)
+        self.assertEqual(self.read("args").split(), ["-q", "-l", "2", "paper.pdf", "-"])
+
+    def test_no_page_limit(self):
+        frontend(fetch_pages=0).extract_words("paper.pdf")
+        self.assertEqual(self.read("args").split(), ["-q", "paper.pdf", "-"])
+
+class FetchCacheTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        stub_backend.reset()
+        self.addCleanup(stub_backend.reset)
+
+        self.frontend = frontend()
+        self.frontend.cache = FetchCache(path=self.path("fetch-cache"))
+
+    def fetch(self, words):
+        with unittest.mock.patch.object(self.frontend, "extract_words",
+                                        return_value=words) as extract_words:
+            result = self.frontend(filename="paper.pdf", md5="d1")
+        return result, extract_words.call_count
+
+    def test_failed_extraction_not_cached(self):
+        # E.g. pdftotext is missing, or timed out.
+        self.assertEqual(self.fetch(None), (None, 1))
+        self.assertEqual(self.frontend.cache.get("d1", "textsearch"), (False, None))
+        self.assertEqual(self.frontend.cache.get("d1", "tests.stub_backend"),
+                         (False, None))
+
+        stub_backend.RESULTS["paper.pdf"] = {"title": "found"}
+        self.assertEqual(self.fetch(["some", "words"]), ({"title": "found"}, 1))
+        self.assertEqual(self.frontend.cache.get("d1", "textsearch"),
+                         (True, "some words"))
+
+    def test_results_cached(self):
+        self.assertEqual(self.fetch(["some", "words"]), (None, 1))
+        # The negative result and the text are cached.
+        self.assertEqual(self.fetch(["some", "words"]), (None, 0))
+        self.assertEqual(len(stub_backend.CALLS), 1)
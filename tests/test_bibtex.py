@@ -0,0 +1,120 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from tests import TempDirTestCase
+from bibman.formats import bibtex
+from bibman.formats.bibtex import parse_entries, parse_entry, entry_to_dict, \
+        ParseError
+
+# Not in the format of the templates.
+SPECIAL = b"""@string{acm = "ACM Press"}
+@comment{ this is @ignored{x, y}}
+@preamble{"\\newcommand{\\noop}[1]{}"}
+
+@article{a1,
+  title = {A {Nested} = value},
+  publisher = acm # { Inc.},
+  keywords = {x,
+    y},
+}
+
+@comment{
+  keywords = {commented},
+}
+
+@article{a2, title={Short}, keywords = {z}}
+@Article{a3,
+  title = "Quoted {"}Title",
+  journal = acm,
+  year = 2001
+}
+"""
+
+class ParserTest(unittest.TestCase):
+    def test_parse_entries(self):
+        entries = list(parse_entries(SPECIAL))
+        self.assertEqual([(e.reftype, e.citekey) for e in entries],
+                         [("string", None), ("preamble", None), ("article", "a1"),
+                          ("article", "a2"), ("Article", "a3")])
+
+        macros = {"acm": "ACM Press"}
+        self.assertEqual(entry_to_dict(SPECIAL, entries[2], macros),
+                         {"reftype": "article", "citekey": "a1",
+                          "title": "A {Nested} = value",
+                          "publisher": "ACM Press Inc.", "keywords": "x, y"})
+        self.assertEqual(entry_to_dict(SPECIAL, entries[4]),
+                         {"reftype": "Article", "citekey": "a3",
+                          "title": 'Quoted {"}Title', "journal": "acm",
+                          "year": "2001"})
+
+        # Ends at the closing brace, not at the next closing line.
+        self.assertEqual(SPECIAL[entries[3].start:entries[3].end],
+                         b"@article{a2, title={Short}, keywords = {z}}")
+
+    def test_malformed(self):
+        with self.assertRaises(ParseError):
+            parse_entry(b"@article{a, title = {x}", 0)
+        with self.assertRaises(ParseError):
+            parse_entry(b"@article{a, title {x}}", 0)
+
+        # Skipped, and the next entry is parsed.
+        entries = list(parse_entries(b"@article{a, title = {x}\n@article{b, year = 1}\n"))
+        self.assertEqual([e.citekey for e in entries], ["b"])
+
+class IndexTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open(self.path("lib.bib"), "wb") as f:
+            f.write(SPECIAL)
+
+    def test_index(self):
+        bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY, bibtex.KEYWORDS,
+                                  bibtex.TITLE, bibtex.YEAR, bibtex.JOURNAL)
+
+        offsets = [SPECIAL.index(b"@article{a1"), SPECIAL.index(b"@article{a2"),
+                   SPECIAL.index(b"@Article{a3")]
+        # Special entries are not indexed.
+        self.assertEqual(sorted(bibfmt.index[bibtex.CITEKEY]), ["a1", "a2", "a3"])
+        self.assertEqual(bibfmt.entry_offsets(), offsets)
+
+        # Values containing '=' are parsed.
+        self.assertEqual(list(bibfmt.query(bibtex.TITLE, "value")), offsets[:1])
+        self.assertEqual(list(bibfmt.query(bibtex.KEYWORDS, "y")), offsets[:1])
+        self.assertIsNone(bibfmt.query(bibtex.KEYWORDS, "commented"))
+        self.assertEqual(list(bibfmt.query(bibtex.TITLE, "quoted")), offsets[2:])
+        self.assertEqual(list(bibfmt.query(bibtex.YEAR, "2001")), offsets[2:])
+
+        # Entries with fields on the line of the cite-key are parsed.
+        self.assertEqual(list(bibfmt.query(bibtex.KEYWORDS, "z")), offsets[1:2])
+        self.assertEqual(list(bibfmt.query(bibtex.TITLE, "short")), offsets[1:2])
+
+        # Strings are substituted.
+        self.assertEqual(list(bibfmt.query(bibtex.JOURNAL, "press")), offsets[2:])
+
+    def test_fields_sharing_lines(self):
+        self.write("lib.bib", "@article{b1, title = {First},\n"
+                              "  keywords = {x},\n}\n"
+                              "@article{b2,\n  title = {Second}, year = {2002},\n"
+                              "  keywords = {y},\n}\n")
+        bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY, bibtex.KEYWORDS,
+                                  bibtex.TITLE, bibtex.YEAR)
+
+        b1, b2 = (bibfmt.index[bibtex.CITEKEY][c] for c in ("b1", "b2"))
+        self.assertEqual(list(bibfmt.query(bibtex.TITLE, "first")), [b1])
+        self.assertEqual(list(bibfmt.query(bibtex.KEYWORDS, "x")), [b1])
+        self.assertEqual(list(bibfmt.query(bibtex.YEAR, "2002")), [b2])
+        self.assertEqual(list(bibfmt.query(bibtex.KEYWORDS, "y")), [b2])
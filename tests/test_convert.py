@@ -0,0 +1,73 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import types
+
+from tests import TempDirTestCase
+from tests.test_bibtex import SPECIAL
+from bibman.commands import convert
+from bibman.formats import bibtex, bibstore
+from bibman.formats.bibtex import parse_entries, entry_to_dict, read_macros
+
+def parsed_entries(text):
+    buf = text.encode()
+    macros = read_macros(buf)
+    return [(bytes(buf[e.start:e.end]), entry_to_dict(buf, e, macros))
+            for e in parse_entries(buf)]
+
+class ConvertTest(TempDirTestCase):
+    def convert(self, source, output, source_format, to_format):
+        args = argparse.Namespace(bibfile=self.path(source), output=self.path(output),
+                                  format=source_format, to_format=to_format,
+                                  append=False)
+        conf = types.SimpleNamespace(
+                args=args, bibfmt_module=__import__(
+                    "bibman.formats.{}".format(source_format), fromlist=["*"]),
+                bibfmt_args=dict(index_cache=False))
+        self.assertIsNone(convert.main(conf))
+
+    def test_round_trip(self):
+        with open(self.path("lib.bib"), "wb") as f:
+            f.write(SPECIAL)
+
+        self.convert("lib.bib", "lib.store", "bibtex", "bibstore")
+        self.convert("lib.store", "out.bib", "bibstore", "bibtex")
+
+        # Comments are not copied; all other entries are copied once.
+        expected = parsed_entries(SPECIAL.decode())
+        self.assertEqual(parsed_entries(self.read("out.bib")), expected)
+        self.assertEqual(len(expected), 5)
+
+        store = self.open_bibfmt("lib.store", bibtex.CITEKEY, bibtex.KEYWORDS,
+                                 module=bibstore)
+        self.assertEqual(sorted(store.index[bibtex.CITEKEY]), ["a1", "a2", "a3"])
+        self.assertEqual([store.read_entry(filepos)["citekey"]
+                          for filepos in store.entry_offsets()], ["a1", "a2", "a3"])
+        self.assertEqual(store.query(bibtex.KEYWORDS, "z"),
+                         [store.index[bibtex.CITEKEY]["a2"][0]])
+
+    def test_read_entries(self):
+        with open(self.path("lib.bib"), "wb") as f:
+            f.write(SPECIAL)
+        bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY)
+
+        expected = [entry for entry in parsed_entries(SPECIAL.decode())
+                    if entry[1]["citekey"] is not None]
+        entries = list(bibfmt.read_entries(bibfmt.entry_offsets()))
+        self.assertEqual([(e.raw.rstrip(), dict(e)) for e in entries], expected)
+
+        for entry in entries:
+            self.assertEqual(bibfmt.read_entry(entry.filepos).raw, entry.raw)
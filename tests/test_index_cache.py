@@ -0,0 +1,65 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import unittest.mock
+
+from tests import TempDirTestCase
+from bibman.formats import bibtex
+
+ENTRIES = """@article{knuth84,
+  title = {Literate Programming},
+  keywords = {programming, literate},
+}
+
+@article{lamport78,
+  title = {Time, Clocks},
+  keywords = {distributed},
+}
+
+"""
+
+class IndexCacheTest(TempDirTestCase):
+    def test_cache_in_cache_dir(self):
+        self.write("lib.bib", ENTRIES)
+        bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY, bibtex.KEYWORDS)
+
+        cache_path = bibtex.index_cache_path(self.path("lib.bib"))
+        self.assertTrue(cache_path.startswith(bibtex.INDEX_CACHE_DIR))
+        self.assertTrue(os.path.exists(cache_path))
+        # Nothing is written next to the bibliography.
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["cache", "lib.bib"])
+
+        self.assertEqual(list(bibfmt.query(bibtex.KEYWORDS, "literate")), [0])
+
+    def test_cache_used(self):
+        self.write("lib.bib", ENTRIES)
+        expected = self.open_bibfmt("lib.bib", bibtex.CITEKEY, bibtex.KEYWORDS).index
+
+        with unittest.mock.patch.object(bibtex, "index_buffer") as index_buffer:
+            bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY, bibtex.KEYWORDS)
+            index_buffer.assert_not_called()
+
+        self.assertEqual(bibfmt.index, expected)
+
+    def test_stale_cache(self):
+        self.write("lib.bib", ENTRIES)
+        self.open_bibfmt("lib.bib", bibtex.CITEKEY)
+
+        # Same size, different content.
+        self.write("lib.bib", ENTRIES.replace("knuth84", "knuth85"))
+        bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY)
+        self.assertIn("knuth85", bibfmt.index[bibtex.CITEKEY])
+        self.assertNotIn("knuth84", bibfmt.index[bibtex.CITEKEY])
@@ -0,0 +1,83 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from array import array
+import unittest
+
+from bibman.formats import bibtex
+from bibman.formats.bibtex import add_posting, insert_posting, merge_index, \
+        as_postings, index_buffer
+
+class PostingsTest(unittest.TestCase):
+    def test_add_posting(self):
+        entries = {}
+        add_posting(entries, "a", 10)
+        self.assertEqual(entries["a"], 10)
+
+        # Same entry again, e.g. a repeated keyword.
+        add_posting(entries, "a", 10)
+        self.assertEqual(entries["a"], 10)
+
+        add_posting(entries, "a", 20)
+        add_posting(entries, "a", 20)
+        add_posting(entries, "a", 30)
+        self.assertIsInstance(entries["a"], array)
+        self.assertEqual(list(entries["a"]), [10, 20, 30])
+
+    def test_insert_posting(self):
+        entries = {}
+        for filepos in (30, 10, 20, 10, 40):
+            insert_posting(entries, "a", filepos)
+        self.assertEqual(list(entries["a"]), [10, 20, 30, 40])
+
+        insert_posting(entries, "b", 5)
+        self.assertEqual(entries["b"], 5)
+
+    def test_as_postings(self):
+        self.assertEqual(as_postings(5), (5,))
+        self.assertEqual(list(as_postings(array(bibtex.POSTING_TYPECODE, [1, 2]))),
+                         [1, 2])
+
+    def test_merge_index(self):
+        shared = array(bibtex.POSTING_TYPECODE, [1, 2])
+        index = {bibtex.KEYWORDS: {"a": shared, "b": 3},
+                 bibtex.FILE: {"x.pdf": 1}}
+        merge_index(index, {
+            bibtex.KEYWORDS: {"a": 10, "b": array(bibtex.POSTING_TYPECODE, [11, 12]),
+                              "c": 13},
+            bibtex.FILE: {"x.pdf": 14}})
+
+        self.assertEqual(list(index[bibtex.KEYWORDS]["a"]), [1, 2, 10])
+        self.assertEqual(list(index[bibtex.KEYWORDS]["b"]), [3, 11, 12])
+        self.assertEqual(index[bibtex.KEYWORDS]["c"], 13)
+        # Unique indices map to the last entry.
+        self.assertEqual(index[bibtex.FILE]["x.pdf"], 14)
+        # Posting lists are replaced, not modified.
+        self.assertEqual(list(shared), [1, 2])
+
+    def test_index_buffer(self):
+        buf = (b"@article{a,\n  keywords = {x, y},\n  file = {a.pdf},\n}\n\n"
+               b"@article{b,\n  keywords = {x},\n}\n\n"
+               b"@article{a,\n  keywords = {y},\n}\n")
+        index = {bibtex.CITEKEY: {}, bibtex.KEYWORDS: {}, bibtex.FILE: {}}
+        scan_state = index_buffer(buf, index, (0, False, 0))
+
+        b = buf.index(b"@article{b")
+        a2 = buf.index(b"@article{a", 1)
+        self.assertEqual(scan_state[0], len(buf))
+        self.assertEqual(index[bibtex.CITEKEY], {"a": array(bibtex.POSTING_TYPECODE, [0, a2]), "b": b})
+        self.assertEqual(index[bibtex.KEYWORDS], {"x": array(bibtex.POSTING_TYPECODE, [0, b]),
+                                                  "y": array(bibtex.POSTING_TYPECODE, [0, a2])})
+        self.assertEqual(index[bibtex.FILE], {"a.pdf": 0})
@@ -0,0 +1,89 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import TempDirTestCase
+from bibman.formats import bibtex
+from bibman.querylang import compile_query, query_indices, QueryError
+
+ENTRIES = [
+    ("ml", "Deep Learning", "Smith", "2001", "machine learning, neural networks"),
+    ("rd", "Research and Development", "Jones", "1999", "R&D"),
+    ("cache", "Caches", "Smith", "2004", "cache, memory"),
+    ("deep", "Learning Deeply", "Jones", "2010", "machine learning, cache"),
+]
+
+class QueryLangTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("lib.bib", "".join(
+            "@article{{{},\n  title = {{{}}},\n  author = {{{}}},\n  year = {{{}}},\n"
+            "  keywords = {{{}}},\n}}\n\n".format(*entry) for entry in ENTRIES))
+
+    def query(self, text, default_index=bibtex.KEYWORDS):
+        plan = compile_query(text, default_index, bibtex.QUERY_FIELDS,
+                             bibtex.TEXT_FIELDS)
+        bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY, *query_indices(plan))
+        citekeys = {filepos: citekey for citekey, filepos
+                    in bibfmt.index[bibtex.CITEKEY].items()}
+        return sorted(citekeys[filepos] for filepos in plan.evaluate(bibfmt))
+
+    def test_multi_word_value(self):
+        self.assertEqual(self.query("machine learning"), ["deep", "ml"])
+        self.assertEqual(self.query("keywords:machine learning"), ["deep", "ml"])
+        self.assertEqual(self.query("machine   learning"), ["deep", "ml"])
+        self.assertEqual(self.query("neural net*"), ["ml"])
+        self.assertEqual(self.query("machine"), [])
+
+    def test_operators_within_words(self):
+        self.assertEqual(self.query("R&D"), ["rd"])
+        self.assertEqual(self.query("memory & cache"), ["cache"])
+        self.assertEqual(self.query("memory | R&D"), ["cache", "rd"])
+
+    def test_and(self):
+        self.assertEqual(self.query("machine learning, cache"), ["deep"])
+        self.assertEqual(self.query("machine learning AND cache"), ["deep"])
+        self.assertEqual(self.query("machine learning year:2001"), ["ml"])
+        self.assertEqual(self.query('cache "machine learning"'), ["deep"])
+
+    def test_text_index_words(self):
+        # Words of full-text indices are not joined.
+        self.assertEqual(self.query('title:"learning deep*"'), ["deep", "ml"])
+        self.assertEqual(self.query("title:learning deep*"), [])
+        self.assertEqual(self.query("learning research", bibtex.TITLE), [])
+
+    def test_tex_markup(self):
+        with open(self.path("lib.bib"), "a") as f:
+            f.write('@article{bayes,\n  title = {A {B}ayesian Approach},\n'
+                    '  author = {Schr\\"{o}dinger},\n}\n')
+
+        self.assertEqual(self.query('title:"bayesian approach"'), ["bayes"])
+        self.assertEqual(self.query("title:{B}ayesian"), ["bayes"])
+        self.assertEqual(self.query("author:schrodinger"), ["bayes"])
+
+    def test_boolean(self):
+        self.assertEqual(self.query("(cache OR year:1999..2001) NOT author:smith"),
+                         ["deep", "rd"])
+        self.assertEqual(self.query("NOT cache"), ["ml", "rd"])
+        self.assertEqual(self.query("machine learning ~ R&D"), ["deep", "ml", "rd"])
+
+    def test_citekey(self):
+        self.assertEqual(self.query("ml, deep ~ rd", bibtex.CITEKEY), ["rd"])
+        self.assertEqual(self.query("ml ~ rd", bibtex.CITEKEY), ["ml", "rd"])
+
+    def test_invalid(self):
+        for text in ("", "(cache", "cache OR", "year:20..x"):
+            with self.assertRaises(QueryError):
+                compile_query(text, bibtex.KEYWORDS, bibtex.QUERY_FIELDS,
+                              bibtex.TEXT_FIELDS)
@@ -0,0 +1,122 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import unittest.mock
+
+from tests import TempDirTestCase
+from bibman.formats import bibtex
+
+ENTRY = """@article{{{citekey},
+  title = {{Entry {citekey}}},
+  keywords = {{{keywords}}},
+}}
+
+"""
+
+def entries(*citekeys, keywords="common"):
+    return "".join(ENTRY.format(citekey=citekey, keywords=keywords)
+                   for citekey in citekeys)
+
+INDICES = (bibtex.CITEKEY, bibtex.KEYWORDS)
+
+class ResumeIndexTest(TempDirTestCase):
+    def assertIndexEqual(self, bibfmt, name):
+        """
+        Asserts that the index of bibfmt equals one built from scratch.
+        """
+        expected = self.open_bibfmt(name, *INDICES, index_cache=False)
+        for index in INDICES:
+            self.assertEqual({key: list(bibtex.as_postings(value))
+                              for key, value in bibfmt.index[index].items()},
+                             {key: list(bibtex.as_postings(value))
+                              for key, value in expected.index[index].items()})
+
+    def test_cache_resumes_after_append(self):
+        self.write("lib.bib", entries("a", "b"))
+        indexed = self.open_bibfmt("lib.bib", *INDICES).scan_state[0]
+
+        with open(self.path("lib.bib"), "a") as f:
+            f.write(entries("c", keywords="common, new"))
+
+        with unittest.mock.patch.object(bibtex, "index_buffer",
+                                        wraps=bibtex.index_buffer) as index_buffer:
+            bibfmt = self.open_bibfmt("lib.bib", *INDICES)
+            # Only the appended entry is scanned.
+            self.assertEqual(index_buffer.call_count, 1)
+            self.assertEqual(index_buffer.call_args[0][2][0], indexed)
+
+        self.assertEqual(list(bibfmt.query(bibtex.KEYWORDS, "common")),
+                         bibfmt.entry_offsets())
+        self.assertIndexEqual(bibfmt, "lib.bib")
+
+    def test_append_entries(self):
+        self.write("lib.bib", entries("a", "b"))
+        bibfmt = self.open_bibfmt("lib.bib", *INDICES, mode="r+")
+
+        bibfmt.append_entries([entries("c"), entries("d", keywords="new")])
+        self.assertIn("d", bibfmt.index[bibtex.CITEKEY])
+        self.assertIndexEqual(bibfmt, "lib.bib")
+
+        # The flushed cache covers the appended entries.
+        bibfmt.flush_index()
+        with unittest.mock.patch.object(bibtex, "index_buffer") as index_buffer:
+            cached = self.open_bibfmt("lib.bib", *INDICES)
+            index_buffer.assert_not_called()
+        self.assertIndexEqual(cached, "lib.bib")
+
+    def test_updated(self):
+        self.write("lib.bib", entries("a", "b"))
+        bibfmt = self.open_bibfmt("lib.bib", *INDICES)
+        old_index = {name: dict(index) for name, index in bibfmt.index.items()}
+
+        with open(self.path("lib.bib"), "a") as f:
+            f.write(entries("c"))
+
+        updated = bibfmt.updated()
+        self.assertIsNotNone(updated)
+        self.assertIndexEqual(updated, "lib.bib")
+        # The index of the old BibFmt is unchanged.
+        self.assertEqual(bibfmt.index, old_index)
+
+    def test_updated_after_edit(self):
+        self.write("lib.bib", entries("a", "b"))
+        bibfmt = self.open_bibfmt("lib.bib", *INDICES)
+
+        self.write("lib.bib", entries("a", "x", "c"))
+        self.assertIsNone(bibfmt.updated())
+
+    def test_updated_after_edit_and_append(self):
+        # Large enough that the edit is far from the beginning and end.
+        citekeys = ["e{:05}".format(i) for i in range(4000)]
+        self.write("lib.bib", entries(*citekeys))
+        bibfmt = self.open_bibfmt("lib.bib", *INDICES)
+
+        # Same-length edit in the middle, then an append.
+        text = self.read("lib.bib").replace("{e02000,", "{x02000,")
+        self.write("lib.bib", text + entries("c"))
+        self.assertIsNone(bibfmt.updated())
+        # The index cache is not resumed either.
+        self.assertIndexEqual(self.open_bibfmt("lib.bib", *INDICES), "lib.bib")
+
+    def test_updated_after_replace(self):
+        self.write("lib.bib", entries("a", "b"))
+        bibfmt = self.open_bibfmt("lib.bib", *INDICES)
+
+        # Replaced by rename, e.g. by an editor, with entries appended.
+        self.write("new.bib", entries("a", "b", "c"))
+        os.replace(self.path("new.bib"), self.path("lib.bib"))
+
+        self.assertIsNone(bibfmt.updated())
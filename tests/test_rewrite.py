@@ -0,0 +1,168 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+
+from tests import TempDirTestCase
+from tests.test_bibtex import SPECIAL
+from bibman.formats import bibtex, bibstore
+from bibman.formats.bibtex import rewrite_entry, ParseError
+
+INDICES = (bibtex.CITEKEY, bibtex.KEYWORDS, bibtex.FILE, bibtex.TITLE)
+
+def new_entry(i, path=None):
+    return dict(reftype="article", citekey="key{}".format(i), author="Author",
+                title="Title {}".format(i), year="2000",
+                keywords="kw{}, common".format(i % 3),
+                file=path or "/papers/{}.pdf".format(i), annotation="",
+                date_added="2016")
+
+def index_lists(bibfmt):
+    return {name: {key: list(bibtex.as_postings(value)) for key, value in index.items()}
+            for name, index in bibfmt.index.items()}
+
+class RewriteEntryTest(TempDirTestCase):
+    def test_change_add_remove(self):
+        raw = b"@article{a,\n  title = {Old},\n  year = 2000,\n  note = {x}\n}\n"
+        self.assertEqual(rewrite_entry(raw, {"title": "New = {nested}", "year": None,
+                                             "keywords": "k"}),
+                         b"@article{a,\n  title = {New = {nested}},\n  note = {x},\n"
+                         b"  keywords = {k},\n}\n")
+
+        with self.assertRaises(ParseError):
+            rewrite_entry(b"@article{a, title = {x}, year = 1}", {"title": None})
+
+    def test_file_padding(self):
+        bibfmt = bibtex.BibFmt(None)
+        raw = bibfmt.template.safe_substitute(
+                **bibfmt._process_extra(new_entry(1))).encode()
+        line_len = len(next(line for line in raw.splitlines() if b"file =" in line))
+
+        for path in ("/" + "x" * 200 + ".pdf", "/short.pdf"):
+            lines = rewrite_entry(raw, {"file": path}).splitlines()
+            line = next(line for line in lines if b"file =" in line)
+            self.assertEqual(line, "  file = {{{}}},".format(path).encode().ljust(line_len))
+
+class RewriteTest(TempDirTestCase):
+    def write_entries(self, name, count):
+        bibfmt = bibtex.BibFmt(open(self.path(name), "w"))
+        for i in range(count):
+            bibfmt.append_new_entry(**new_entry(i))
+        bibfmt.bibfile.close()
+
+    def assertIndexRebuilt(self, bibfmt, name):
+        expected = self.open_bibfmt(name, *INDICES, index_cache=False)
+        self.assertEqual(index_lists(bibfmt), index_lists(expected))
+
+    def test_one_line_entry(self):
+        with open(self.path("lib.bib"), "wb") as f:
+            f.write(SPECIAL)
+        bibfmt = self.open_bibfmt("lib.bib", *INDICES, mode="r+")
+        a2 = bibfmt.index[bibtex.CITEKEY]["a2"]
+
+        self.assertTrue(bibfmt.rewrite({a2: None}))
+
+        text = self.read("lib.bib")
+        self.assertNotIn("a2", text)
+        self.assertEqual(text, SPECIAL.decode().replace(
+                "@article{a2, title={Short}, keywords = {z}}\n", ""))
+
+        a3 = bibfmt.index[bibtex.CITEKEY]["a3"]
+        self.assertTrue(text[a3:].startswith("@Article{a3,"))
+        self.assertEqual(bibfmt.read_entry(a3)["title"], 'Quoted {"}Title')
+        self.assertIndexRebuilt(bibfmt, "lib.bib")
+
+    def test_edit_one_line_entry(self):
+        with open(self.path("lib.bib"), "wb") as f:
+            f.write(SPECIAL)
+        bibfmt = self.open_bibfmt("lib.bib", *INDICES, mode="r+")
+        a2 = bibfmt.index[bibtex.CITEKEY]["a2"]
+
+        self.assertTrue(bibfmt.rewrite({a2: {"title": "Longer title"}}))
+        self.assertEqual(dict(bibfmt.read_entry(a2)),
+                         {"reftype": "article", "citekey": "a2",
+                          "title": "Longer title", "keywords": "z"})
+        a3 = bibfmt.index[bibtex.CITEKEY]["a3"]
+        self.assertTrue(self.read("lib.bib")[a3:].startswith("@Article{a3,"))
+
+    def test_malformed_refused(self):
+        text = "@article{a,\n  title = {x},\n}\n\n@article{b,\n  title = {unbalanced,\n}\n"
+        self.write("lib.bib", text)
+        bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY, mode="r+")
+
+        b = bibfmt.index[bibtex.CITEKEY]["b"]
+        self.assertFalse(bibfmt.rewrite({b: None}))
+        self.assertFalse(bibfmt.rewrite({0: {"title": "y"}, b + 1: None}))
+        self.assertEqual(self.read("lib.bib"), text)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["cache", "lib.bib"])
+
+    def rewrite_many(self, **kwargs):
+        self.write_entries("lib.bib", 60)
+        bibfmt = self.open_bibfmt("lib.bib", *INDICES, mode="r+", **kwargs)
+        offsets = bibfmt.entry_offsets()
+
+        edits = {}
+        for i, filepos in enumerate(offsets):
+            if i % 5 == 0:
+                edits[filepos] = None
+            elif i % 5 == 1:
+                edits[filepos] = {"file": "/moved/" + "x" * 150 + str(i), "keywords": "new"}
+            elif i % 5 == 2:
+                edits[filepos] = {"title": "T", "annotation": None}
+
+        self.assertTrue(bibfmt.rewrite(edits))
+        self.assertEqual(len(bibfmt.entry_offsets()), 48)
+        self.assertEqual(len(bibfmt.query(bibtex.KEYWORDS, "new")), 12)
+        self.assertIsNone(bibfmt.query(bibtex.CITEKEY, "key5"))
+
+        # Appended entries are indexed incrementally.
+        bibfmt.append_new_entry(**new_entry(100))
+        self.assertIn("key100", bibfmt.index[bibtex.CITEKEY])
+
+        self.assertIndexRebuilt(bibfmt, "lib.bib")
+        bibfmt.flush_index()
+        return bibfmt
+
+    def test_rewrite_index(self):
+        self.rewrite_many(index_cache=False)
+
+    def test_rewrite_index_cache(self):
+        self.rewrite_many()
+        # The cache written by flush_index is valid.
+        cached = self.open_bibfmt("lib.bib", *INDICES)
+        self.assertIndexRebuilt(cached, "lib.bib")
+
+    def test_rewrite_index_db(self):
+        bibfmt = self.rewrite_many(index_db=True)
+        self.assertIsNotNone(bibfmt.index_db)
+
+    def test_bibstore(self):
+        with open(self.path("lib.bib"), "wb") as f:
+            f.write(SPECIAL)
+        source = bibtex.BibFmt(open(self.path("lib.bib")))
+        self.addCleanup(source.bibfile.close)
+        store = bibstore.BibFmt(open(self.path("lib.store"), "a+"))
+        self.addCleanup(store.bibfile.close)
+        store.append_entries(source.read_all_entries())
+        store.build_index(*INDICES)
+
+        a1, = store.query(bibtex.CITEKEY, "a1")
+        a2, = store.query(bibtex.CITEKEY, "a2")
+        self.assertTrue(store.rewrite({a1: {"keywords": "new"}, a2: None}))
+
+        self.assertEqual(store.query(bibtex.KEYWORDS, "new"), [a1])
+        self.assertIsNone(store.query(bibtex.KEYWORDS, "z"))
+        self.assertIsNone(store.query(bibtex.CITEKEY, "a2"))
+        self.assertEqual(store.read_entry(a1)["title"], "A {Nested} = value")
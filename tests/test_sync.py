@@ -0,0 +1,73 @@
+# Copyright (c) 2012-2016, Marco Elver <me AT marcoelver.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import hashlib
+import os
+import types
+import unittest.mock
+
+from tests import TempDirTestCase
+from bibman.commands import sync
+from bibman.formats import bibtex
+
+ENTRY = """@misc{{a,
+  file = {{~/pdfs/a.pdf}},
+  md5 = {{{}}}
+}}
+"""
+
+class SyncTest(TempDirTestCase):
+    def sync(self, *paths, **kwargs):
+        """
+        Runs sync with lib.bib for paths, appending new entries.
+        """
+        args = dict(bibfile=self.path("lib.bib"), paths=[self.tmpdir],
+                    extlist=["pdf"], include=None, ignore=None, walk_jobs=1,
+                    append=True, excludes=None, hash=True, hash_jobs=4,
+                    hash_cache=False, interactive=False, remote=False,
+                    rename=False, verify=False, full=False)
+        args.update(kwargs)
+        conf = types.SimpleNamespace(args=argparse.Namespace(**args),
+                                     bibfmt_module=bibtex,
+                                     bibfmt_args=dict(index_cache=False))
+
+        # Paths are walked in the given order, and all digests are computed
+        # before the first path is processed.
+        with unittest.mock.patch.object(sync.SyncCommand, "walk_path",
+                                        return_value=iter(paths)), \
+                unittest.mock.patch.object(
+                        sync, "ordered_map",
+                        lambda func, iterable, jobs: list(map(func, iterable))):
+            self.assertIsNone(sync.main(conf))
+
+    def test_duplicate_of_indexed_path(self):
+        os.mkdir(self.path("pdfs"))
+        for name in ("a.pdf", "b.pdf"):
+            self.write(os.path.join("pdfs", name), "same")
+        digest = hashlib.md5(b"same").hexdigest()
+
+        # The file field is not expanded when checking whether the file still
+        # exists, so the entry is taken to be missing its file; it is updated
+        # to the duplicate b.pdf before a.pdf, which was in the index when it
+        # was looked ahead, is processed.
+        self.write("lib.bib", ENTRY.format(digest))
+
+        with unittest.mock.patch.dict(os.environ, HOME=self.tmpdir):
+            self.sync("~/pdfs/b.pdf", "~/pdfs/a.pdf")
+
+        bibfmt = self.open_bibfmt("lib.bib", bibtex.CITEKEY, bibtex.HASH)
+        self.assertEqual(list(bibfmt.index[bibtex.CITEKEY]), ["a"])
+        self.assertNotIn("None", self.read("lib.bib"))